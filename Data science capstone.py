@@ -53,6 +53,26 @@ import pandas as pd
 import numpy as np
 # Datetime is a library that allows us to represent dates
 import datetime
+# ThreadPoolExecutor lets us send several API requests at the same time from a bounded pool of threads
+from concurrent.futures import ThreadPoolExecutor
+# OrderedDict, json, os and time are used to keep the API responses in a cache in memory and on disk
+from collections import OrderedDict
+import itertools
+import json
+import os
+import time
+# hashlib and threading are used by the response cache, HTTPAdapter and Retry let the requests session pool connections and retry failed calls
+import hashlib
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+# codecs lets us decode the launches response piece by piece while it is streamed
+import codecs
+# base64, gzip and io are used to save recorded API responses and play them back
+import base64
+import gzip
+import io
+from urllib3.response import HTTPResponse
 
 # Setting this option will print all collumns of a dataframe
 pd.set_option('display.max_columns', None)
@@ -60,20 +80,391 @@ pd.set_option('display.max_columns', None)
 pd.set_option('display.max_colwidth', None)
 
 
+# To see where the time and memory of the capstone go, the slow steps are run inside <code>instrumentStage</code>: the API helpers, <code>json_normalize</code>, the <code>to_sql</code> load, building the folium markers, and every stage run by <code>run_stage</code>, which includes <code>get_dummies</code> and the four grid searches. Each of them adds a record to <code>instrument_records</code> with its wall time, CPU time, number of rows and peak memory, and <code>writeInstrumentReport</code> saves the records of the run as JSON.
+# 
+# Every record has the largest resident size the process has reached so far, <code>process_peak_rss_bytes</code>, which costs one system call per stage. It is a high-water mark of the whole process and only grows, so it shows when the process reached its peak but not how much memory one stage used. Tracing every allocation with <code>tracemalloc</code> gives the peak of each stage on its own, <code>peak_traced_bytes</code>, but slows Python code down a lot, so it is only done when <code>instrument_tracemalloc</code> is True. Tracing started by other code, such as <code>benchmarkIngestion</code> or a profiler, is left alone, because measuring a stage resets the peak that code would read. <code>startInstrumentRun</code> clears the records, so a report only holds the stages of one run.
+# 
+
+# In[ ]:
+
+
+import contextlib
+import functools
+import platform
+import resource
+import tracemalloc
+import uuid
+
+# The records of the stages of this run, and whether stages are timed at all
+instrument_records = []
+instrument_enabled = True
+# When True, tracemalloc is started and the peak of the memory allocated by Python is recorded for every stage
+instrument_tracemalloc = False
+# Whether the tracing was started by instrumentStage, the peaks of tracing started elsewhere belong to the code that started it
+instrument_tracing = False
+instrument_report_path = 'capstone_report.json'
+instrument_run_id = uuid.uuid4().hex
+# The peak traced memory of the stages that are running, so a stage inside another one does not hide its peak from the outer one
+instrument_peaks = []
+
+# Takes the name of a stage and the number of rows it works on, and records the time and memory spent inside the with block. The record is yielded so the rows can be set once they are known
+@contextlib.contextmanager
+def instrumentStage(stage, rows=None):
+    global instrument_tracing
+    if not instrument_enabled:
+        yield {}
+        return
+    if instrument_tracemalloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        instrument_tracing = True
+    tracing = instrument_tracing and tracemalloc.is_tracing()
+    if tracing:
+        if instrument_peaks:
+            instrument_peaks[-1] = max(instrument_peaks[-1], tracemalloc.get_traced_memory()[1])
+        instrument_peaks.append(0)
+        tracemalloc.reset_peak()
+        traced = tracemalloc.get_traced_memory()[0]
+    record = {'stage': stage, 'rows': rows, 'started': time.time()}
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter()-wall
+        record['cpu_seconds'] = time.process_time()-cpu
+        record['process_peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if platform.system() == 'Darwin' else 1024)
+        if tracing:
+            peak = max(instrument_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            # The most memory the stage held at once on top of what was allocated before it started
+            record['peak_traced_bytes'] = peak-traced
+            if instrument_peaks:
+                instrument_peaks[-1] = max(instrument_peaks[-1], peak)
+        instrument_records.append(record)
+
+# Takes a value and returns its number of rows, using the first item of a tuple such as a train test split, or None when it has no rows
+def instrumentRows(value):
+    if isinstance(value, (tuple, list)) and value and hasattr(value[0], 'shape'):
+        value = value[0]
+    if hasattr(value, 'shape'):
+        return value.shape[0] if len(value.shape) else None
+    return len(value) if isinstance(value, (list, dict)) else None
+
+# Takes the name of a stage and returns a decorator that runs the function inside instrumentStage, counting the rows of its first argument
+def instrumented(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with instrumentStage(stage, instrumentRows(args[0]) if args else None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Starts a new run, forgetting the records of the previous one
+def startInstrumentRun():
+    global instrument_run_id
+    instrument_records.clear()
+    instrument_run_id = uuid.uuid4().hex
+
+# Writes the records of this run to a JSON file and returns them
+def writeInstrumentReport(path=None):
+    report = {'run_id': instrument_run_id,
+              'python': platform.python_version(),
+              'pandas': pd.__version__,
+              'stages': instrument_records}
+    with open((path or instrument_report_path)+'.tmp', 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+    os.replace((path or instrument_report_path)+'.tmp', path or instrument_report_path)
+    return report
+
+
 # Below we will define a series of helper functions that will help us use the API to extract information using identification numbers in the launch data.
 # 
+# Each helper needs one API call per launch. Instead of waiting for every call in turn, the helpers send them through a pool of threads: <code>max_workers</code> sets how many requests can be in flight at the same time, and the responses come back in the same order as the rows of the dataset.
+# 
+# There are only a handful of different rockets and launch pads, and the same core flies several times, so the helpers first collect the unique IDs of each endpoint and fetch every one of them only once. The responses are kept in <code>entity_cache</code>, which is also saved to <code>spacex_entity_cache.json</code>, so running the lab again does not call the API for IDs we have already seen. Entries older than <code>entity_cache_ttl</code> seconds are fetched again, and once the cache holds more than <code>entity_cache_size</code> entities the least recently used ones are dropped.
+# 
+# All of the requests go through one <code>session</code>, which keeps connections to the API open between calls and retries failed calls with an increasing delay, waiting as long as the <code>Retry-After</code> header asks when the API rate limits us. Response bodies are stored in <code>http_cache</code> under the SHA-256 hash of their content, together with the <code>ETag</code> and <code>Last-Modified</code> headers of each url, so when a cached entity has expired the API is asked whether it changed and answers with an empty <code>304 Not Modified</code> when it did not.
+# 
+# The API also has a <code>/query</code> route for every endpoint, which takes a filter such as <code>{'_id': {'$in': [...]}}</code> and returns the matching documents one page at a time. Setting <code>bulk_page_size</code> to a number makes the helpers resolve the missing IDs of an endpoint with a few of these calls, each asking for a batch of <code>bulk_page_size</code> IDs, instead of one request per ID. An ID the API does not return raises an error naming it.
+# 
+
+# In[ ]:
+
+
+# The base url of the SpaceX API, the helpers build their requests from it
+spacex_api_url = "https://api.spacexdata.com/v4/"
+# Number of seconds to wait for the API before giving up on a request
+http_timeout = 30
+
+# One session for all requests, keeping up to 32 connections open and retrying failed or rate limited calls. The /query calls only read data, so POST requests are retried as well
+session = requests.Session()
+retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=None, respect_retry_after_header=True)
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries))
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries))
+
+# Response bodies are saved in http_cache_dir under the hash of their content, the index maps each url to the hash and validators of its last response
+http_cache_dir = 'http_cache'
+http_cache_index = {}
+http_cache_lock = threading.Lock()
+
+# Reads the response cache index saved by a previous run, if there is one
+def loadHttpCache():
+    os.makedirs(http_cache_dir, exist_ok=True)
+    http_cache_index.clear()
+    if os.path.exists(os.path.join(http_cache_dir, 'index.json')):
+        with open(os.path.join(http_cache_dir, 'index.json')) as f:
+            http_cache_index.update(json.load(f))
+
+# Writes the response cache index to disk
+def saveHttpCache():
+    path = os.path.join(http_cache_dir, 'index.json')
+    with http_cache_lock:
+        with open(path+'.tmp', 'w') as f:
+            json.dump(http_cache_index, f)
+    os.replace(path+'.tmp', path)
+
+# Takes a response body, stores it under the hash of its content and returns the hash
+def writeBlob(content):
+    digest = hashlib.sha256(content).hexdigest()
+    path = os.path.join(http_cache_dir, digest)
+    if not os.path.exists(path):
+        with open(path+'.'+str(threading.get_ident()), 'wb') as f:
+            f.write(content)
+        os.replace(path+'.'+str(threading.get_ident()), path)
+    return digest
+
+# Takes a hash and returns the stored response body
+def readBlob(digest):
+    with open(os.path.join(http_cache_dir, digest), 'rb') as f:
+        return f.read()
+
+# Takes a url and returns the response body, sending the validators of the cached response so an unchanged resource is answered with a 304 and read from the cache
+def getCached(url):
+    entry = http_cache_index.get(url)
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    response = session.get(url, headers=headers, timeout=http_timeout)
+    if response.status_code == 304 and entry:
+        try:
+            return readBlob(entry['sha256'])
+        except FileNotFoundError:
+            # The cached body has been deleted, so its entry is dropped and the url is requested again without validators
+            with http_cache_lock:
+                http_cache_index.pop(url, None)
+            return getCached(url)
+    response.raise_for_status()
+    digest = writeBlob(response.content)
+    if 'ETag' in response.headers or 'Last-Modified' in response.headers:
+        with http_cache_lock:
+            http_cache_index[url] = {'sha256': digest, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    return response.content
+
+# Takes a list of urls, requests them on a bounded thread pool and returns the json responses in the same order as the urls
+def getJsonConcurrently(urls, max_workers=16):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = list(executor.map(lambda url: json.loads(getCached(url)), urls))
+    saveHttpCache()
+    return responses
+
+# Takes an endpoint and a query, posts it to the /query route of the endpoint and returns all matching documents, page_size documents per call
+def queryApi(endpoint, query, page_size=100):
+    docs = []
+    page = 1
+    while page:
+        response = session.post(spacex_api_url+endpoint+"/query", json={'query': query, 'options': {'limit': page_size, 'page': page}}, timeout=http_timeout)
+        response.raise_for_status()
+        result = response.json()
+        docs.extend(result['docs'])
+        page = result['nextPage'] if result['hasNextPage'] else None
+    return docs
+
+
+# In[ ]:
+
+
+# API responses keyed by (endpoint, id), ordered from least to most recently used
+entity_cache = OrderedDict()
+entity_cache_path = 'spacex_entity_cache.json'
+# Number of seconds a cached response is used before it is fetched again
+entity_cache_ttl = 7*24*60*60
+# Maximum number of responses kept in the cache
+entity_cache_size = 100000
+# Number of documents per page when the IDs are resolved through the /query endpoints, None requests every ID on its own
+bulk_page_size = None
+
+# Reads the cache saved by a previous run, if there is one
+def loadEntityCache(path=None):
+    path = path or entity_cache_path
+    entity_cache.clear()
+    if os.path.exists(path):
+        with open(path) as f:
+            for endpoint, x, fetched, response in json.load(f):
+                entity_cache[(endpoint, x)] = (fetched, response)
+
+# Writes the cache to disk, going through a temporary file so an interrupted run cannot leave a broken cache behind
+def saveEntityCache(path=None):
+    path = path or entity_cache_path
+    with open(path+'.tmp', 'w') as f:
+        json.dump([[endpoint, x, fetched, response] for (endpoint, x), (fetched, response) in entity_cache.items()], f)
+    os.replace(path+'.tmp', path)
+
+# Takes an endpoint and a column of IDs, fetches each unique ID that is not in the cache exactly once and returns a dictionary from ID to API response
+def getEntities(endpoint, ids, max_workers=16):
+    name, endpoint = endpoint, spacex_api_url+endpoint
+    now = time.time()
+    entities = {}
+    missing = []
+    for x in dict.fromkeys(x for x in ids if x):
+        cached = entity_cache.get((endpoint, x))
+        if cached and now-cached[0] < entity_cache_ttl:
+            entity_cache.move_to_end((endpoint, x))
+            entities[x] = cached[1]
+        else:
+            missing.append(x)
+    if missing:
+        if bulk_page_size:
+            # Every query asks for one batch of IDs on a single page, so no ID is sent to the API more than once
+            found = {}
+            for start in range(0, len(missing), bulk_page_size):
+                batch = missing[start:start+bulk_page_size]
+                found.update((doc['id'], doc) for doc in queryApi(name, {'_id': {'$in': batch}}, len(batch)))
+            unresolved = [x for x in missing if x not in found]
+            if unresolved:
+                raise LookupError("The %s query did not return the IDs %s" % (name, unresolved))
+            responses = [found[x] for x in missing]
+        else:
+            responses = getJsonConcurrently([endpoint+"/"+str(x) for x in missing], max_workers)
+        for x, response in zip(missing, responses):
+            entity_cache[(endpoint, x)] = (now, response)
+            entity_cache.move_to_end((endpoint, x))
+            entities[x] = response
+        while len(entity_cache) > entity_cache_size:
+            entity_cache.popitem(last=False)
+        saveEntityCache()
+    return entities
+
+loadHttpCache()
+loadEntityCache()
+
+
+# The labs also read several files from the course's storage: the static launches response, <code>dataset_part_1.csv</code>, <code>dataset_part_2.csv</code>, <code>dataset_part_3.csv</code>, <code>Spacex.csv</code> and <code>spacex_launch_geo.csv</code>. <code>fetchDataset</code> downloads each of them once into <code>http_cache</code>, under the SHA-256 hash of its content like the API responses. The files do not change, so a url that is already in the cache is read from disk without contacting the server at all, and the hash of the file is checked on every read so a damaged file is downloaded again. A hash listed in <code>dataset_checksums</code>, or passed as <code>sha256</code>, must also match the downloaded content. <code>refresh=True</code> asks the server whether the file changed, and with <code>dataset_offline</code> set, or the <code>SPACEX_OFFLINE</code> environment variable set to 1, nothing is downloaded and a file missing from the cache raises an error. <code>readRemoteDataset</code> reads a cached CSV file into a data frame.
+# 
+
+# In[ ]:
+
+
+# When True, datasets are only read from the cache
+dataset_offline = os.environ.get('SPACEX_OFFLINE') == '1'
+# Expected SHA-256 hash of the content of a url, checked on every download and every read from the cache
+dataset_checksums = {}
+
+# Takes the url of a dataset and returns its content, from the cache when it has been downloaded before
+def fetchDataset(url, sha256=None, refresh=False, offline=None):
+    offline = dataset_offline if offline is None else offline
+    sha256 = sha256 or dataset_checksums.get(url)
+    entry = http_cache_index.get(url)
+    if entry:
+        path = os.path.join(http_cache_dir, entry['sha256'])
+        content = readBlob(entry['sha256']) if os.path.exists(path) else None
+        if content is None or hashlib.sha256(content).hexdigest() != entry['sha256']:
+            # The cached file is missing or damaged, so its entry is dropped and it is downloaded again without validators
+            if content is not None:
+                os.remove(path)
+            with http_cache_lock:
+                http_cache_index.pop(url, None)
+        elif sha256 in (None, entry['sha256']) and (not refresh or offline):
+            return content
+    if offline:
+        raise FileNotFoundError("%s is not in the cache and downloads are turned off" % url)
+    content = getCached(url)
+    digest = hashlib.sha256(content).hexdigest()
+    if sha256 and digest != sha256:
+        raise ValueError("Checksum mismatch for %s: expected %s, got %s" % (url, sha256, digest))
+    with http_cache_lock:
+        http_cache_index.setdefault(url, {'etag': None, 'last_modified': None})['sha256'] = digest
+    saveHttpCache()
+    return content
+
+# Takes the url of a CSV dataset and returns it as a data frame, read from the cache when it has been downloaded before
+def readRemoteDataset(url, sha256=None, refresh=False, offline=None, **kwargs):
+    return pd.read_csv(io.BytesIO(fetchDataset(url, sha256, refresh, offline)), **kwargs)
+
+
+# Running the lab against the live API is slow and the timings change from run to run. <code>startCassette('record')</code> makes the session save every request it sends, the launches and every call of the helpers, together with its response, and <code>stopCassette()</code> writes them to the compressed archive <code>spacex_cassette.json.gz</code>. After that, <code>startCassette('replay')</code> answers the same requests from the archive without using the network, which makes runs repeatable and gives a baseline for timing the rest of the ingestion. A request that was not recorded raises an error in replay mode.
+# 
+
+# In[ ]:
+
+
+cassette_path = 'spacex_cassette.json.gz'
+# Recorded responses keyed by method, url and a hash of the request body
+cassette = {}
+cassette_lock = threading.Lock()
+
+# Takes a prepared request and returns the key its response is recorded under
+def cassetteKey(request):
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return request.method+' '+request.url+' '+hashlib.sha256(body).hexdigest()
+
+# A transport adapter that records the responses of the session, or plays recorded responses back without using the network
+class CassetteAdapter(HTTPAdapter):
+    def __init__(self, mode, **kwargs):
+        super().__init__(**kwargs)
+        self.mode = mode
+
+    def send(self, request, **kwargs):
+        key = cassetteKey(request)
+        if self.mode == 'replay':
+            if key not in cassette:
+                raise requests.ConnectionError("No recorded response for "+key)
+            status, headers, content = cassette[key]
+            raw = HTTPResponse(body=io.BytesIO(base64.b64decode(content)), headers=headers, status=status, preload_content=False, decode_content=False)
+            return self.build_response(request, raw)
+        # record full responses, so that replaying does not depend on what is in the response cache
+        request.headers.pop('If-None-Match', None)
+        request.headers.pop('If-Modified-Since', None)
+        response = super().send(request, **kwargs)
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+        with cassette_lock:
+            cassette[key] = (response.status_code, headers, base64.b64encode(response.content).decode('ascii'))
+        return response
+
+# Mounts the cassette on the session, mode is 'record' or 'replay'
+def startCassette(mode, path=cassette_path):
+    cassette.clear()
+    if mode == 'replay' or os.path.exists(path):
+        with gzip.open(path, 'rt') as f:
+            cassette.update(json.load(f))
+    adapter = CassetteAdapter(mode, pool_connections=4, pool_maxsize=32, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+# Writes the recorded responses to the archive and puts the normal adapters back on the session
+def stopCassette(path=cassette_path):
+    if isinstance(session.get_adapter("https://"), CassetteAdapter) and session.get_adapter("https://").mode == 'record':
+        with gzip.open(path, 'wt') as f:
+            json.dump(cassette, f)
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries))
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries))
+
+
 # From the <code>rocket</code> column we would like to learn the booster name.
 # 
 
 # In[3]:
 
 
-# Takes the dataset and uses the rocket column to call the API and append the data to the list
-def getBoosterVersion(data):
-    for x in data['rocket']:
+# Takes the dataset and uses the rocket column to call the API and fill in the BoosterVersion column
+@instrumented('getBoosterVersion')
+def getBoosterVersion(data, columns, max_workers=16):
+    rockets = getEntities("rockets", data['rocket'], max_workers)
+    for i, x in enumerate(data['rocket']):
        if x:
-        response = requests.get("https://api.spacexdata.com/v4/rockets/"+str(x)).json()
-        BoosterVersion.append(response['name'])
+        columns['BoosterVersion'][i] = rockets[x]['name']
 
 
 # From the <code>launchpad</code> we would like to know the name of the launch site being used, the logitude, and the latitude.
@@ -82,14 +473,16 @@ def getBoosterVersion(data):
 # In[5]:
 
 
-# Takes the dataset and uses the launchpad column to call the API and append the data to the list
-def getLaunchSite(data):
-    for x in data['launchpad']:
+# Takes the dataset and uses the launchpad column to call the API and fill in the Longitude, Latitude and LaunchSite columns
+@instrumented('getLaunchSite')
+def getLaunchSite(data, columns, max_workers=16):
+    launchpads = getEntities("launchpads", data['launchpad'], max_workers)
+    for i, x in enumerate(data['launchpad']):
        if x:
-         response = requests.get("https://api.spacexdata.com/v4/launchpads/"+str(x)).json()
-         Longitude.append(response['longitude'])
-         Latitude.append(response['latitude'])
-         LaunchSite.append(response['name'])
+        response = launchpads[x]
+        columns['Longitude'][i] = response['longitude']
+        columns['Latitude'][i] = response['latitude']
+        columns['LaunchSite'][i] = response['name']
 
 
 # From the <code>payload</code> we would like to learn the mass of the payload and the orbit that it is going to.
@@ -98,13 +491,15 @@ def getLaunchSite(data):
 # In[7]:
 
 
-# Takes the dataset and uses the payloads column to call the API and append the data to the lists
-def getPayloadData(data):
-    for load in data['payloads']:
+# Takes the dataset and uses the payloads column to call the API and fill in the PayloadMass and Orbit columns
+@instrumented('getPayloadData')
+def getPayloadData(data, columns, max_workers=16):
+    payloads = getEntities("payloads", data['payloads'], max_workers)
+    for i, load in enumerate(data['payloads']):
        if load:
-        response = requests.get("https://api.spacexdata.com/v4/payloads/"+load).json()
-        PayloadMass.append(response['mass_kg'])
-        Orbit.append(response['orbit'])
+        response = payloads[load]
+        columns['PayloadMass'][i] = response['mass_kg']
+        columns['Orbit'][i] = response['orbit']
 
 
 # From <code>cores</code> we would like to learn the outcome of the landing, the type of the landing, number of flights with that core, whether gridfins were used, wheter the core is reused, wheter legs were used, the landing pad used, the block of the core which is a number used to seperate version of cores, the number of times this specific core has been reused, and the serial of the core.
@@ -113,24 +508,24 @@ def getPayloadData(data):
 # In[8]:
 
 
-# Takes the dataset and uses the cores column to call the API and append the data to the lists
-def getCoreData(data):
-    for core in data['cores']:
-            if core['core'] != None:
-                response = requests.get("https://api.spacexdata.com/v4/cores/"+core['core']).json()
-                Block.append(response['block'])
-                ReusedCount.append(response['reuse_count'])
-                Serial.append(response['serial'])
-            else:
-                Block.append(None)
-                ReusedCount.append(None)
-                Serial.append(None)
-            Outcome.append(str(core['landing_success'])+' '+str(core['landing_type']))
-            Flights.append(core['flight'])
-            GridFins.append(core['gridfins'])
-            Reused.append(core['reused'])
-            Legs.append(core['legs'])
-            LandingPad.append(core['landpad'])
+# Takes the dataset and uses the core columns to call the API and fill in the core columns
+@instrumented('getCoreData')
+def getCoreData(data, columns, max_workers=16):
+    cores = getEntities("cores", data['core'], max_workers)
+    for i, x in enumerate(data['core']):
+            if x:
+                response = cores[x]
+                columns['Block'][i] = response['block']
+                columns['ReusedCount'][i] = response['reuse_count']
+                columns['Serial'][i] = response['serial']
+    # The outcome is written the way str() writes the values, for example 'True ASDS' or 'None None'
+    landing_success = data['landing_success'].map({True: 'True', False: 'False'}).fillna('None')
+    columns['Outcome'][:] = (landing_success+' '+data['landing_type'].fillna('None')).to_numpy()
+    columns['Flights'][:] = data['flight'].to_numpy(dtype=np.float64, na_value=np.nan)
+    columns['GridFins'][:] = data['gridfins'].to_numpy(dtype=object, na_value=None)
+    columns['Reused'][:] = data['reused'].to_numpy(dtype=object, na_value=None)
+    columns['Legs'][:] = data['legs'].to_numpy(dtype=object, na_value=None)
+    columns['LandingPad'][:] = data['landpad'].to_numpy(dtype=object, na_value=None)
 
 
 # Now let's start requesting rocket launch data from SpaceX API with the following URL:
@@ -141,7 +536,7 @@ def getCoreData(data):
 # In[10]:
 
 
-response = requests.get(spacex_url)
+response = session.get(spacex_url, timeout=http_timeout)
 
 
 # Check the content of the response
@@ -182,26 +577,124 @@ print(response.content)
 # 
 # We will now use the API again to get information about the launches using the IDs given for each launch. Specifically we will be using columns <code>rocket</code>, <code>payloads</code>, <code>launchpad</code>, and <code>cores</code>.
 # 
+# The <code>cores</code> and <code>payloads</code> columns hold lists. <code>flattenLaunches</code> explodes them in one pass and turns the fields of each core into typed columns given by <code>core_schema</code>. Falcon Heavy launches carry three cores; by default they are dropped, and with <code>keep_multi_core=True</code> they are kept as one row per core.
+# 
 
 # In[ ]:
 
 
-# Lets take a subset of our dataframe keeping only the features we want and the flight number, and date_utc.
-data = data[['rocket', 'payloads', 'launchpad', 'cores', 'flight_number', 'date_utc']]
+# The columns each core is flattened into and their types, the nullable types keep missing values as <NA>
+core_schema = {'core': object,
+'flight': 'Int64',
+'gridfins': 'boolean',
+'legs': 'boolean',
+'reused': 'boolean',
+'landing_success': 'boolean',
+'landing_type': object,
+'landpad': object}
+
+# Takes launches with cores and payloads lists and returns one row per core with the core fields as typed columns.
+# Launches with more than one payload are dropped, and so are launches with more than one core unless keep_multi_core is True
+def flattenLaunches(data, keep_multi_core=False):
+    data = data[data['payloads'].str.len()==1]
+    if not keep_multi_core:
+        data = data[data['cores'].str.len()==1]
+    data = data.assign(payloads=data['payloads'].str[0]).explode('cores')
+    data = data[data['cores'].notna()]
+    cores = pd.DataFrame(data['cores'].tolist(), columns=list(core_schema), dtype=object).astype(core_schema)
+    cores.index = data.index
+    return pd.concat([data.drop(columns='cores'), cores], axis=1)
+
+# Takes the date_utc column and returns the dates without the time as datetime64, parsed in one vectorized call
+def launchDates(date_utc):
+    return pd.to_datetime(date_utc.str[:10], format='%Y-%m-%d')
+
+# Takes the normalized launches and keeps the launches and features we use, launches after last_date are dropped unless last_date is None
+def selectLaunches(data, last_date=datetime.date(2020, 11, 13), keep_multi_core=False):
+    # Lets take a subset of our dataframe keeping only the features we want and the flight number, and date_utc.
+    data = data[['rocket', 'payloads', 'launchpad', 'cores', 'flight_number', 'date_utc']]
 
-# We will remove rows with multiple cores because those are falcon rockets with 2 extra rocket boosters and rows that have multiple payloads in a single rocket.
-data = data[data['cores'].map(len)==1]
-data = data[data['payloads'].map(len)==1]
+    # We will remove rows with multiple cores because those are falcon rockets with 2 extra rocket boosters and rows that have multiple payloads in a single rocket.
+    # Since payloads and cores are then lists of size 1 we will also extract the single value in the list and turn the fields of the core into columns.
+    data = flattenLaunches(data, keep_multi_core)
 
-# Since payloads and cores are lists of size 1 we will also extract the single value in the list and replace the feature.
-data['cores'] = data['cores'].map(lambda x : x[0])
-data['payloads'] = data['payloads'].map(lambda x : x[0])
+    # We also want to convert the date_utc to a datetime datatype and then extracting the date leaving the time
+    data['date'] = launchDates(data['date_utc'])
+
+    # Using the date we will restrict the dates of the launches
+    if last_date is not None:
+        data = data[data['date'] <= pd.Timestamp(last_date)]
+    return data
+
+data = selectLaunches(data)
+
+
+# The cells above hold the whole response in memory three times: as bytes, as decoded json and as a normalized data frame with every nested field. When the launches response grows to hundreds of MB this is more than we need, so <code>streamLaunches</code> reads the response while it is downloaded, decodes one launch at a time, drops launches with more than one core or payload or after <code>last_date</code>, and keeps only the fields above. <code>streamLaunches(static_json_url)</code> returns the same data frame as <code>selectLaunches</code>, while the memory used stays the same however large the response is.
+# 
+
+# In[ ]:
 
-# We also want to convert the date_utc to a datetime datatype and then extracting the date leaving the time
-data['date'] = pd.to_datetime(data['date_utc']).dt.date
 
-# Using the date we will restrict the dates of the launches
-data = data[data['date'] <= datetime.date(2020, 11, 13)]
+# Takes a json decoding error and returns whether the text only stops too early, so more text could complete it
+def jsonIncomplete(error):
+    rest = error.doc[error.pos:]
+    # An unterminated string runs to the end of the text, and a literal or number cut short is the start of a complete one
+    return (error.msg.startswith('Unterminated string') or any(literal.startswith(rest) for literal in ('true', 'false', 'null', 'NaN', 'Infinity', '-Infinity'))
+            or not rest.strip('0123456789+-.eE'))
+
+# Takes an iterable of text chunks holding a json array and yields the items of the array one at a time
+def iterJsonArray(chunks):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    # None marks the end of the chunks, after which whatever is left in the buffer has to decode
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buffer += chunk or ''
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("Expected a json array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as error:
+                if final or not jsonIncomplete(error):
+                    raise
+                # the item is not complete yet, wait for the next chunk
+                break
+            if end == len(buffer) and not final:
+                # a number at the end of the buffer may go on in the next chunk
+                break
+            pos = end
+            yield item
+        buffer = buffer[pos:]
+    raise ValueError("The json array is not closed")
+
+# Takes the url of the launches and streams them, keeping the same launches and fields as selectLaunches
+def streamLaunches(url, last_date=datetime.date(2020, 11, 13), keep_multi_core=False, chunk_size=64*1024):
+    rows = []
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with session.get(url, stream=True, timeout=http_timeout) as response:
+        response.raise_for_status()
+        for launch in iterJsonArray(decoder.decode(chunk) for chunk in response.iter_content(chunk_size)):
+            if len(launch['payloads'])!=1 or (len(launch['cores'])!=1 and not keep_multi_core):
+                continue
+            if last_date is not None and launch['date_utc'][:10] > last_date.isoformat():
+                continue
+            rows.append((launch['rocket'], launch['payloads'], launch['launchpad'], launch['cores'], launch['flight_number'], launch['date_utc']))
+    data = pd.DataFrame(rows, columns=['rocket', 'payloads', 'launchpad', 'cores', 'flight_number', 'date_utc'])
+    data['date'] = launchDates(data['date_utc'])
+    return flattenLaunches(data, keep_multi_core)[['rocket', 'payloads', 'launchpad', 'flight_number', 'date_utc', *core_schema, 'date']]
 
 
 # * From the <code>rocket</code> we would like to learn the booster name
@@ -212,34 +705,40 @@ data = data[data['date'] <= datetime.date(2020, 11, 13)]
 # 
 # * **From <code>cores</code> we would like to learn the outcome of the landing, the type of the landing, number of flights with that core, whether gridfins were used, whether the core is reused, whether legs were used, the landing pad used, the block of the core which is a number used to seperate version of cores, the number of times this specific core has been reused, and the serial of the core.**
 # 
-# The data from these requests will be stored in lists and will be used to create a new dataframe.
+# The data from these requests will be stored in one NumPy array per column and will be used to create a new dataframe. The arrays are created with one element for each row of <code>data</code> before we call the API, and the helpers fill them in by position, so calling a helper again overwrites its values instead of adding more.
 # 
 
 # In[16]:
 
 
-#Global variables 
-BoosterVersion = []
-PayloadMass = []
-Orbit = []
-LaunchSite = []
-Outcome = []
-Flights = []
-GridFins = []
-Reused = []
-Legs = []
-LandingPad = []
-Block = []
-ReusedCount = []
-Serial = []
-Longitude = []
-Latitude = []
+# The NumPy data type of each column we collect, numbers that can be missing are stored as floats so they can hold NaN
+launch_schema = {'BoosterVersion': object,
+'PayloadMass': np.float64,
+'Orbit': object,
+'LaunchSite': object,
+'Outcome': object,
+'Flights': np.float64,
+'GridFins': object,
+'Reused': object,
+'Legs': object,
+'LandingPad': object,
+'Block': np.float64,
+'ReusedCount': np.float64,
+'Serial': object,
+'Longitude': np.float64,
+'Latitude': np.float64}
 
+# Takes the dataset and creates an empty array for every column with one element per launch
+def newLaunchColumns(data):
+    return {name: np.full(len(data), np.nan if dtype == np.float64 else None, dtype=dtype) for name, dtype in launch_schema.items()}
 
-# These functions will apply the outputs globally to the above variables. Let's take a looks at <code>BoosterVersion</code> variable. Before we apply  <code>getBoosterVersion</code> the list is empty:
+launch_columns = newLaunchColumns(data)
+
+
+# These functions will fill in the arrays of <code>launch_columns</code>. Let's take a looks at the <code>BoosterVersion</code> column. Before we apply  <code>getBoosterVersion</code> the array only holds <code>None</code>:
 # 
 
-# BoosterVersion
+# launch_columns['BoosterVersion']
 
 # Now, let's apply <code> getBoosterVersion</code> function method to get the booster version
 # 
@@ -248,16 +747,16 @@ Latitude = []
 
 
 # Call getBoosterVersion
-getBoosterVersion(data)
+getBoosterVersion(data, launch_columns)
 
 
-# the list has now been update 
+# the array has now been update 
 # 
 
 # In[ ]:
 
 
-BoosterVersion[0:5]
+launch_columns['BoosterVersion'][0:5]
 
 
 # we can apply the rest of the  functions here:
@@ -267,21 +766,21 @@ BoosterVersion[0:5]
 
 
 # Call getLaunchSite
-getLaunchSite(data)
+getLaunchSite(data, launch_columns)
 
 
 # In[ ]:
 
 
 # Call getPayloadData
-getPayloadData(data)
+getPayloadData(data, launch_columns)
 
 
 # In[ ]:
 
 
 # Call getCoreData
-getCoreData(data)
+getCoreData(data, launch_columns)
 
 
 # Finally lets construct our dataset using the data we have obtained. We we combine the columns into a dictionary.
@@ -290,26 +789,12 @@ getCoreData(data)
 # In[ ]:
 
 
-launch_dict = {'FlightNumber': list(data['flight_number']),
-'Date': list(data['date']),
-'BoosterVersion':BoosterVersion,
-'PayloadMass':PayloadMass,
-'Orbit':Orbit,
-'LaunchSite':LaunchSite,
-'Outcome':Outcome,
-'Flights':Flights,
-'GridFins':GridFins,
-'Reused':Reused,
-'Legs':Legs,
-'LandingPad':LandingPad,
-'Block':Block,
-'ReusedCount':ReusedCount,
-'Serial':Serial,
-'Longitude': Longitude,
-'Latitude': Latitude}
+launch_dict = {'FlightNumber': data['flight_number'].to_numpy(),
+'Date': data['date'].to_numpy(),
+**launch_columns}
 
 
-# Then, we need to create a Pandas data frame from the dictionary launch_dict.
+# Then, we need to create a Pandas data frame from the dictionary launch_dict. Passing <code>copy=False</code> lets the data frame use the arrays as they are instead of copying them.
 # 
 
 # In[24]:
@@ -318,6 +803,22 @@ launch_dict = {'FlightNumber': list(data['flight_number']),
 # Create a data from launch_dict
 
 
+# All of the steps above are collected in <code>buildLaunchFrame</code>, which takes the filtered <code>data</code> and returns the launch data frame. Every call starts from new arrays, so it is safe to run it again.
+# 
+
+# In[ ]:
+
+
+# Takes the dataset, calls the four helpers and returns the launch data frame
+def buildLaunchFrame(data, max_workers=16):
+    columns = newLaunchColumns(data)
+    getBoosterVersion(data, columns, max_workers)
+    getLaunchSite(data, columns, max_workers)
+    getPayloadData(data, columns, max_workers)
+    getCoreData(data, columns, max_workers)
+    return pd.DataFrame({'FlightNumber': data['flight_number'].to_numpy(), 'Date': data['date'].to_numpy(), **columns}, copy=False)
+
+
 # Show the summary of the dataframe
 # 
 
@@ -381,6 +882,56 @@ Calculate below the mean for the <code>PayloadMass</code> using the <code>.mean(
 # Replace the np.nan values with its mean value
 
 
+# The mean of the whole column ignores that the payload mass depends a lot on the orbit and the rocket: a launch to GTO carries a very different payload from a launch to the ISS. <code>imputePayloadMass</code> instead replaces a missing payload mass with the mean of the launches with the same <code>Orbit</code> and <code>BoosterVersion</code>, falling back to the mean of the orbit and then of the whole column when a group has no payload masses. The means are found with one group by over the dataset, and only the rows with missing values are looked up afterwards.
+# 
+# The statistics are kept as running sums and counts, so they can also be built chunk by chunk with <code>updatePayloadMassStats</code> for data that does not fit in memory: one scan over the chunks adds up the statistics and <code>fillPayloadMass</code> then fills every chunk with them.
+# 
+
+# In[ ]:
+
+
+# The columns whose values make up the groups, from the finest to the coarsest
+payload_mass_groups = ['Orbit', 'BoosterVersion']
+
+# Takes a frame of group values and returns it as a text index, so groups from different chunks and missing values can be matched
+def payloadMassKeys(keys):
+    return pd.MultiIndex.from_frame(keys.astype(object).fillna('None').astype(str))
+
+# Takes a chunk of the dataset and the statistics of the chunks before it and returns the running sum and count of PayloadMass for every group
+def updatePayloadMassStats(data, stats=None, by=payload_mass_groups):
+    chunk_stats = data.groupby(by, observed=True, dropna=False, sort=False)['PayloadMass'].agg(['sum', 'count'])
+    chunk_stats.index = payloadMassKeys(chunk_stats.index.to_frame(index=False))
+    return chunk_stats if stats is None else stats.add(chunk_stats, fill_value=0)
+
+# Takes a chunk of the dataset and the statistics and replaces missing PayloadMass with the mean of the finest group that has payload masses
+def fillPayloadMass(data, stats, by=payload_mass_groups):
+    missing = data['PayloadMass'].isna().to_numpy()
+    if not missing.any():
+        return data
+    keys = payloadMassKeys(data.loc[missing, by]).to_frame(index=False)
+    fill = np.full(len(keys), stats['sum'].sum()/stats['count'].sum())
+    for level in range(1, len(by)+1):
+        totals = stats.groupby(level=list(range(level))).sum()
+        totals.index = pd.MultiIndex.from_frame(totals.index.to_frame(index=False))
+        means = (totals['sum']/totals['count'].where(totals['count'] > 0)).reindex(pd.MultiIndex.from_frame(keys.iloc[:, :level])).to_numpy()
+        fill = np.where(np.isnan(means), fill, means)
+    data = data.copy()
+    data.loc[missing, 'PayloadMass'] = fill
+    return data
+
+# Takes the dataset and returns it with missing PayloadMass replaced by the mean of its group
+def imputePayloadMass(data, by=payload_mass_groups):
+    return fillPayloadMass(data, updatePayloadMassStats(data, by=by), by)
+
+# Takes a function that returns an iterator over the chunks of a dataset and yields the chunks with missing PayloadMass replaced
+def imputePayloadMassChunks(chunks, by=payload_mass_groups):
+    stats = None
+    for chunk in chunks():
+        stats = updatePayloadMassStats(chunk, stats, by)
+    for chunk in chunks():
+        yield fillPayloadMass(chunk, stats, by)
+
+
 # You should see the number of missing values of the <code>PayLoadMass</code> change to zero.
 # Now we should have no missing values in our dataset except for in <code>LandingPad</code>.
 # We can now export it to a <b>CSV</b> for the next section,but to make the answers consistent, in the next lab we will provide data in a pre-selected date range. 
@@ -392,6 +943,362 @@ Calculate below the mean for the <code>PayloadMass</code> using the <code>.mean(
 <code>data_falcon9.to_csv('dataset_part_1.csv', index=False)</code>
 
 
+# CSV files are slow to read back and lose the data types of the columns: booleans, dates and the <code>None</code> values of <code>LandingPad</code> all come back as text or <code>NaN</code>. The stages therefore hand their data to each other with <code>writeDataset</code> and <code>readDataset</code>, which store a data frame in the columnar Feather or Parquet format with its data types. Feather files are written uncompressed and read memory mapped, so the numeric columns are used straight from the file without being copied. <code>dataset_format</code> sets the format, and CSV is still used when <code>pyarrow</code> is not installed.
+# 
+# Each lab ends by writing its dataset, and the next one reads it with <code>readStageDataset</code>, which only downloads the course's copy when there is no file from an earlier stage. A downloaded dataset is saved in <code>dataset_format</code> too, so it is only parsed as CSV once. Delete a file, for example <code>dataset_part_1.feather</code>, to go back to the course's copy with its pre-selected date range.
+# 
+
+# In[ ]:
+
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    # The format used to hand datasets between stages: 'feather', 'parquet' or 'csv'
+    dataset_format = 'feather'
+except ImportError:
+    feather = None
+    dataset_format = 'csv'
+
+# Takes a data frame and a dataset name such as 'dataset_part_1', writes it in dataset_format and returns the path of the file
+def writeDataset(df, name, format=None):
+    format = format or dataset_format
+    path = name+'.'+format
+    # Written to a temporary file first, so a data frame still memory mapped from the old file is not cut short
+    if format == 'feather':
+        # Uncompressed, so the file can be memory mapped when it is read
+        df.reset_index(drop=True).to_feather(path+'.tmp', compression='uncompressed')
+    elif format == 'parquet':
+        df.to_parquet(path+'.tmp', index=False)
+    else:
+        df.to_csv(path+'.tmp', index=False)
+    os.replace(path+'.tmp', path)
+    return path
+
+# Takes a dataset name, or the path or url of a file, and returns it as a data frame, reading only the given columns if there are any
+def readDataset(name, columns=None, format=None):
+    path = name if os.path.splitext(name)[1] else name+'.'+(format or dataset_format)
+    extension = os.path.splitext(path)[1]
+    if extension == '.feather':
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    if extension == '.parquet':
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+# Takes a dataset name and the url of the course's copy, and returns the file written by an earlier stage, downloading and saving the course's copy when there is none
+def readStageDataset(name, url, columns=None, format=None):
+    if os.path.exists(name+'.'+(format or dataset_format)):
+        return readDataset(name, columns, format)
+    df = readRemoteDataset(url)
+    writeDataset(df, name, format)
+    return df[columns] if columns else df
+
+# Takes a dataset name, or the path of a file, and yields it as data frames of at most chunk_size rows, so only one chunk is in memory at a time
+def readDatasetChunks(name, chunk_size=100000, columns=None, format=None):
+    path = name if os.path.splitext(name)[1] else name+'.'+(format or dataset_format)
+    extension = os.path.splitext(path)[1]
+    if extension == '.feather':
+        # The file is memory mapped, so only the rows of the chunk being converted are read
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        for offset in range(0, table.num_rows, chunk_size):
+            yield table.slice(offset, chunk_size).to_pandas(split_blocks=True)
+    elif extension == '.parquet':
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+
+# Takes data frames with the same columns and a dataset name, appends every data frame to the file as it comes and yields it on
+def writeDatasetChunks(chunks, name, format=None):
+    format = format or dataset_format
+    path = name+'.'+format
+    writer = None
+    try:
+        for i, chunk in enumerate(chunks):
+            if format == 'csv':
+                chunk.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            else:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    # A column with only missing values in the first chunk is written as text
+                    schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema], metadata=table.schema.metadata)
+                    if format == 'feather':
+                        writer = pa.ipc.new_file(path, schema)
+                    else:
+                        writer = pq.ParquetWriter(path, schema)
+                writer.write_table(table.cast(schema))
+            yield chunk
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+# ### Refreshing the dataset with new launches
+# 
+# Downloading and enriching the whole launch history every time we want the latest launches gets slower as the history grows. Instead, <code>ingestNewLaunches</code> keeps a small watermark file next to the dataset with the highest <code>flight_number</code> and its <code>date_utc</code> that have already been ingested. It asks the <code>launches/query</code> endpoint only for past launches with a higher flight number, runs them through the same steps as above and appends the Falcon 9 rows to <code>dataset_part_1</code> in <code>dataset_format</code>, the file the next labs read, so the enrichment costs time in proportion to the number of new launches.
+# 
+# The watermark also keeps the number of rows in the dataset, used to continue the <code>FlightNumber</code> column, and the running sums and counts of <code>PayloadMass</code> made by <code>updatePayloadMassStats</code>, so missing payload masses are filled by <code>fillPayloadMass</code> with the same group means as above without reading the dataset again. The cell below writes the dataset of this lab and seeds the watermark from it with <code>seedWatermark</code>, so the first refresh only fetches the launches after it. When there is no watermark, the dataset is written from scratch.
+# 
+
+# In[ ]:
+
+
+dataset_part_1_name = 'dataset_part_1'
+watermark_path = dataset_part_1_name+'.watermark.json'
+
+# Reads the watermark of the dataset, or returns None if nothing has been ingested yet
+def readWatermark(path=watermark_path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# Takes the statistics made by updatePayloadMassStats and returns them as rows of the group values, the sum and the count, which can be stored as json
+def payloadMassStatsRows(stats):
+    return [[*keys, float(row['sum']), int(row['count'])] for keys, row in stats.iterrows()]
+
+# Takes rows made by payloadMassStatsRows and returns the statistics again, or None if there are no rows
+def payloadMassStatsFromRows(rows, by=payload_mass_groups):
+    if not rows:
+        return None
+    stats = pd.DataFrame(rows, columns=[*by, 'sum', 'count'])
+    return stats.set_index(payloadMassKeys(stats[by]))[['sum', 'count']]
+
+# Writes the watermark through a temporary file so it is never left half written
+def writeWatermark(watermark, path=watermark_path):
+    with open(path+'.tmp', 'w') as f:
+        json.dump(watermark, f)
+    os.replace(path+'.tmp', path)
+
+# Takes the selected launches and the Falcon 9 launch data frame before missing values are replaced, and writes the watermark of a dataset built from them
+def seedWatermark(data, launches, path=watermark_path):
+    newest = data.loc[data['flight_number'].idxmax()]
+    writeWatermark({'flight_number': int(newest['flight_number']), 'date_utc': newest['date_utc'], 'rows': len(launches),
+                    'payload_mass_stats': payloadMassStatsRows(updatePayloadMassStats(launches))}, path)
+
+# Fetches the launches newer than the watermark, enriches them and appends the Falcon 9 launches to the dataset, returns the appended rows
+def ingestNewLaunches(name=dataset_part_1_name, watermark_path=watermark_path, last_date=None, page_size=100, max_workers=16, format=None):
+    watermark = readWatermark(watermark_path)
+    if watermark is None:
+        watermark = {'flight_number': 0, 'date_utc': None, 'rows': 0, 'payload_mass_stats': []}
+    launches = queryApi('launches', {'upcoming': False, 'flight_number': {'$gt': watermark['flight_number']}}, page_size)
+    if not launches:
+        return pd.DataFrame(columns=['FlightNumber', 'Date', *launch_schema])
+    launches = pd.json_normalize(launches)
+    if last_date is not None:
+        launches = launches[launchDates(launches['date_utc']) <= pd.Timestamp(last_date)]
+        if launches.empty:
+            return pd.DataFrame(columns=['FlightNumber', 'Date', *launch_schema])
+
+    new_launches = buildLaunchFrame(selectLaunches(launches, last_date), max_workers)
+    new_launches = new_launches[new_launches['BoosterVersion']!='Falcon 1'].reset_index(drop=True)
+    new_launches['FlightNumber'] = np.arange(watermark['rows']+1, watermark['rows']+len(new_launches)+1)
+
+    stats = updatePayloadMassStats(new_launches, payloadMassStatsFromRows(watermark['payload_mass_stats']))
+    watermark['payload_mass_stats'] = payloadMassStatsRows(stats)
+    if stats['count'].sum():
+        new_launches = fillPayloadMass(new_launches, stats)
+
+    if watermark['rows']:
+        writeDataset(pd.concat([readDataset(name, format=format), new_launches], ignore_index=True), name, format)
+    else:
+        writeDataset(new_launches, name, format)
+    newest = launches.loc[launches['flight_number'].idxmax()]
+    watermark.update({'flight_number': int(newest['flight_number']), 'date_utc': newest['date_utc'], 'rows': watermark['rows']+len(new_launches)})
+    writeWatermark(watermark, watermark_path)
+    return new_launches
+
+launch_frame = pd.DataFrame(launch_dict)
+writeDataset(data_falcon9, dataset_part_1_name)
+seedWatermark(data, launch_frame[launch_frame['BoosterVersion']!='Falcon 1'])
+
+
+# ### Measuring the ingestion
+# 
+# The real API only gives us about 90 launches, which is too few to see how the ingestion behaves on a longer history. <code>makeSyntheticLaunches</code> makes up any number of launches in the shape the API returns them, with a chosen number of distinct rockets, launch pads and cores and a share of launches with several cores or payloads. <code>startMockApi</code> serves them from a local stand-in for the v4 API, which answers the launches, single-ID and <code>/query</code> routes, waits <code>latency</code> seconds before every answer and fails <code>error_rate</code> of the requests with a <code>503</code>. The stand-in runs in a process of its own, so the memory it uses to answer is not counted with the ingestion's. Where processes cannot be forked, as on Windows, it runs in a thread and its memory is counted too.
+# 
+# <code>benchmarkIngestion</code> points the helpers at the stand-in, runs the whole path from streaming the launches to <code>buildLaunchFrame</code> for each scale (a multiple of the 90 real launches) and reports the rows built per second, the number of requests the stand-in answered and the peak memory traced by <code>tracemalloc</code>, measured with <code>instrumentStage</code> so the stages of the helpers inside it do not hide the peak. The caches are moved to a temporary folder while it runs, so every scale starts cold and the real caches are left alone.
+# 
+
+# In[ ]:
+
+
+import multiprocessing
+import random
+import tempfile
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Takes the number of launches to make and returns a list of launches in the shape of the API and a dictionary of the entities they refer to
+def makeSyntheticLaunches(n_launches, n_rockets=3, n_launchpads=4, n_cores=None, multi_core_rate=0.05, multi_payload_rate=0.05, seed=0):
+    rng = random.Random(seed)
+    n_cores = n_cores or max(1, n_launches//3)
+    orbits = ['LEO', 'ISS', 'PO', 'GTO', 'ES-L1', 'SSO', 'HEO', 'MEO', 'VLEO', 'SO', 'GEO']
+    landing_types = ['ASDS', 'RTLS', 'Ocean', None]
+    entities = {'rockets': {}, 'launchpads': {}, 'payloads': {}, 'cores': {}}
+    for i in range(n_rockets):
+        entities['rockets']['rocket%019d' % i] = {'id': 'rocket%019d' % i, 'name': (['Falcon 1', 'Falcon 9', 'Falcon Heavy']+['Rocket %d' % i])[min(i, 3)]}
+    for i in range(n_launchpads):
+        entities['launchpads']['launchpad%016d' % i] = {'id': 'launchpad%016d' % i, 'name': 'SLC %d' % i, 'longitude': rng.uniform(-180, 180), 'latitude': rng.uniform(-60, 60)}
+    for i in range(n_cores):
+        entities['cores']['core%021d' % i] = {'id': 'core%021d' % i, 'block': rng.choice([1, 2, 3, 4, 5, None]), 'reuse_count': rng.randint(0, 12), 'serial': 'B%04d' % i}
+    rockets, launchpads, cores = list(entities['rockets']), list(entities['launchpads']), list(entities['cores'])
+
+    launches = []
+    first, last = datetime.datetime(2006, 3, 24), datetime.datetime(2020, 11, 13)
+    for i in range(n_launches):
+        payloads = []
+        for j in range(2 if rng.random() < multi_payload_rate else 1):
+            payload = 'payload%09d%08d' % (i, j)
+            entities['payloads'][payload] = {'id': payload, 'mass_kg': None if rng.random() < 0.1 else round(rng.uniform(20, 16000), 1), 'orbit': rng.choice(orbits)}
+            payloads.append(payload)
+        landing_type = rng.choice(landing_types)
+        launch_cores = [{'core': rng.choice(cores + [None]), 'flight': rng.randint(1, 13), 'gridfins': rng.random() < 0.8, 'legs': rng.random() < 0.8, 'reused': rng.random() < 0.5,
+                         'landing_success': None if landing_type is None else rng.random() < 0.8, 'landing_type': landing_type, 'landpad': None}
+                        for k in range(3 if rng.random() < multi_core_rate else 1)]
+        launches.append({'flight_number': i+1, 'date_utc': (first+(last-first)*i/n_launches).strftime('%Y-%m-%dT%H:%M:%S.000Z'), 'upcoming': False,
+                         'rocket': rng.choice(rockets), 'launchpad': rng.choice(launchpads), 'payloads': payloads, 'cores': launch_cores})
+    return launches, entities
+
+# Takes a query of the /query routes and a document, and returns whether the document matches the query
+def matchesQuery(query, doc):
+    for field, condition in query.items():
+        value = doc.get('id' if field == '_id' else field)
+        if isinstance(condition, dict):
+            if '$in' in condition and value not in condition['$in']:
+                return False
+            if '$gt' in condition and not value > condition['$gt']:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+# Starts a local stand-in for the v4 API serving the launches and entities, returns a function that stops it, its base url and a dictionary counting the requests
+def startMockApi(launches, entities, latency=0.0, error_rate=0.0, seed=0):
+    rng = random.Random(seed)
+    # The counts are shared with the process the stand-in runs in
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    stats = {'requests': context.Value('i', 0, lock=False), 'errors': context.Value('i', 0, lock=False)}
+    lock = context.Lock()
+    collections = dict(entities, launches={launch['flight_number']: launch for launch in launches})
+    launches_body = json.dumps(launches).encode('utf-8')
+
+    class MockApiHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body=b'', headers={}):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def start(self):
+            time.sleep(latency)
+            with lock:
+                stats['requests'].value += 1
+                failed = rng.random() < error_rate
+                stats['errors'].value += failed
+            if failed:
+                self.reply(503, headers={'Retry-After': '0'})
+            return not failed
+
+        def do_GET(self):
+            if not self.start():
+                return
+            parts = self.path.strip('/').split('/')
+            if parts[-2:] == ['launches', 'past']:
+                return self.reply(200, launches_body, {'Content-Type': 'application/json'})
+            doc = entities.get(parts[-2], {}).get(parts[-1])
+            if doc is None:
+                return self.reply(404)
+            etag = '"'+hashlib.sha256(json.dumps(doc, sort_keys=True).encode('utf-8')).hexdigest()+'"'
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply(304, headers={'ETag': etag})
+            self.reply(200, json.dumps(doc).encode('utf-8'), {'Content-Type': 'application/json', 'ETag': etag})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if not self.start():
+                return
+            parts = self.path.strip('/').split('/')
+            query, options = body.get('query', {}), body.get('options', {})
+            if '$in' in query.get('_id', {}):
+                docs = [collections[parts[-2]][x] for x in query['_id']['$in'] if x in collections[parts[-2]]]
+            else:
+                docs = [doc for doc in collections[parts[-2]].values() if matchesQuery(query, doc)]
+            limit, page = options.get('limit', 10), options.get('page', 1)
+            pages = max(1, -(-len(docs)//limit))
+            result = {'docs': docs[(page-1)*limit:page*limit], 'totalDocs': len(docs), 'limit': limit, 'page': page, 'totalPages': pages,
+                      'hasNextPage': page < pages, 'nextPage': page+1 if page < pages else None}
+            self.reply(200, json.dumps(result).encode('utf-8'), {'Content-Type': 'application/json'})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockApiHandler)
+    server.daemon_threads = True
+    url = 'http://127.0.0.1:%d/v4/' % server.server_port
+    if context.get_start_method() != 'fork':
+        # Without fork the handler cannot be sent to another process, so the stand-in answers from a thread of this one
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        def stop():
+            server.shutdown()
+            server.server_close()
+        return stop, url, stats
+    # The socket is bound before the fork, so the stand-in accepts connections as soon as this returns
+    process = context.Process(target=server.serve_forever, daemon=True)
+    process.start()
+    server.server_close()
+    def stop():
+        process.terminate()
+        process.join()
+    return stop, url, stats
+
+# Runs the ingestion against the stand-in API for every scale and returns a data frame with the rows per second, the number of requests and the peak memory
+def benchmarkIngestion(scales=(1, 100, 10000), base_launches=90, latency=0.05, error_rate=0.0, max_workers=16, page_size=None, **synthetic):
+    global spacex_api_url, bulk_page_size, entity_cache_path, http_cache_dir, instrument_enabled, instrument_tracemalloc, instrument_tracing
+    saved = spacex_api_url, bulk_page_size, entity_cache_path, http_cache_dir, instrument_enabled, instrument_tracemalloc
+    # The run is measured as a stage of its own, so the stages of the helpers inside it add their peaks to it instead of resetting it
+    instrument_enabled, instrument_tracemalloc = True, True
+    was_tracing = tracemalloc.is_tracing()
+    results = []
+    try:
+        for scale in scales:
+            launches, entities = makeSyntheticLaunches(base_launches*scale, **synthetic)
+            stop, spacex_api_url, stats = startMockApi(launches, entities, latency, error_rate)
+            bulk_page_size = page_size
+            # The caches of every scale are deleted with their folder, in per-ID mode they hold a file for every entity
+            with tempfile.TemporaryDirectory() as temporary:
+                entity_cache_path, http_cache_dir = os.path.join(temporary, 'entities.json'), os.path.join(temporary, 'http_cache')
+                loadEntityCache()
+                loadHttpCache()
+                try:
+                    with instrumentStage('benchmarkIngestion', len(launches)) as record:
+                        launch_data = streamLaunches(spacex_api_url+'launches/past', last_date=None)
+                        frame = buildLaunchFrame(launch_data, max_workers)
+                finally:
+                    stop()
+            # There is no peak when tracing was started by other code, whose peak it would reset
+            peak = record.get('peak_traced_bytes', np.nan)
+            results.append({'scale': scale, 'launches': len(launches), 'rows': len(frame), 'seconds': record['wall_seconds'], 'rows_per_second': len(frame)/record['wall_seconds'],
+                            'requests': stats['requests'].value, 'errors': stats['errors'].value, 'peak_memory_mb': peak/2**20})
+    finally:
+        if instrument_tracing and not was_tracing:
+            tracemalloc.stop()
+            instrument_tracing = False
+        spacex_api_url, bulk_page_size, entity_cache_path, http_cache_dir, instrument_enabled, instrument_tracemalloc = saved
+        loadEntityCache()
+        loadHttpCache()
+    return pd.DataFrame(results)
+
+
+# For example, <code>benchmarkIngestion(scales=(1, 100), page_size=None)</code> compares one request per ID at the current size and at 100 times the current size, and <code>benchmarkIngestion(scales=(1, 100, 10000), page_size=1000)</code> uses the bulk <code>/query</code> calls. At 10,000 times the current size there are close to a million launches, so it is best run with <code>page_size</code> set.
+# 
+
 # # **Space X  Falcon 9 First Stage Landing Prediction**
 # 
 
@@ -436,7 +1343,7 @@ import numpy as np
 # In[32]:
 
 
-df=pd.read_csv("https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/dataset_part_1.csv")
+df=readStageDataset('dataset_part_1', "https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/dataset_part_1.csv")
 df.head(10)
 
 
@@ -458,6 +1365,104 @@ df.isnull().sum()/len(df)*100
 df.dtypes
 
 
+# Most of these columns use more memory than they need: text columns such as <code>Orbit</code>, <code>LaunchSite</code> and <code>Outcome</code> repeat a handful of values as Python strings, <code>GridFins</code>, <code>Reused</code> and <code>Legs</code> hold Python booleans, and small numbers are stored as 64-bit integers or floats. <code>compact_dtypes</code> turns repeated text into categoricals, booleans into the nullable <code>boolean</code> type, integers into the narrowest integer type that holds them and floats into <code>float32</code> when that holds them exactly, and returns a report of the memory each column used before and after. Floats are never turned into integers, even when they hold whole numbers, so a column such as <code>PayloadMass</code> can still be filled with a mean. Besides the memory, grouping by a categorical column is much faster than grouping by strings, which is why the EDA lab compacts <code>dataset_part_2</code> before grouping it.
+# 
+# <code>make_synthetic_launch_table</code> makes up a launch table of any size with the columns of this dataset, to try the steps of the labs on much more data than the real launches.
+# 
+
+# In[ ]:
+
+
+from pandas.api.types import is_bool_dtype, is_float_dtype, is_integer_dtype
+
+# Takes a data frame and returns a copy with compact data types and a report of the memory used by each column before and after
+def compact_dtypes(df, max_category_ratio=0.5):
+    columns = {}
+    for name, column in df.items():
+        if is_bool_dtype(column.dtype) or isinstance(column.dtype, pd.CategoricalDtype):
+            columns[name] = column
+        elif is_integer_dtype(column.dtype):
+            values = column.dropna()
+            columns[name] = column
+            # The narrowest integer type that holds the values, nullable when the column already was
+            for dtype in (np.int8, np.int16, np.int32, np.int64):
+                if not len(values) or np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max:
+                    columns[name] = column.astype(dtype if isinstance(column.dtype, np.dtype) else np.dtype(dtype).name.capitalize())
+                    break
+        elif is_float_dtype(column.dtype):
+            # Floats stay floats even when they hold whole numbers, so they keep taking the means that fill their missing values
+            values = column.dropna()
+            columns[name] = column.astype(np.float32) if (values.astype(np.float32).astype(np.float64) == values).all() else column
+        else:
+            uniques = pd.unique(column.dropna())
+            if len(uniques) and all(isinstance(value, (bool, np.bool_)) for value in uniques):
+                columns[name] = column.astype('boolean')
+            elif len(uniques) <= max_category_ratio*len(column):
+                columns[name] = column.astype('category')
+            else:
+                columns[name] = column
+    compact = pd.DataFrame(columns, index=df.index)
+    report = pd.DataFrame({'dtype_before': df.dtypes.astype(str), 'dtype_after': compact.dtypes.astype(str),
+                           'bytes_before': df.memory_usage(deep=True, index=False), 'bytes_after': compact.memory_usage(deep=True, index=False)})
+    report.loc['Total'] = ['', '', report['bytes_before'].sum(), report['bytes_after'].sum()]
+    print("Memory usage: %.1f MB before, %.1f MB after" % (report.loc['Total', 'bytes_before']/2**20, report.loc['Total', 'bytes_after']/2**20))
+    return compact, report
+
+# Takes a number of rows and returns a made up launch table with the columns of the dataset
+def make_synthetic_launch_table(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    outcomes = np.array(list(landing_outcome_class))
+    outcome = outcomes[rng.choice(len(outcomes), n_rows, p=[0.45, 0.15, 0.05, 0.07, 0.02, 0.02, 0.02, 0.22])]
+    sites = np.array(['CCAFS SLC 40', 'KSC LC 39A', 'VAFB SLC 4E'])
+    site = rng.integers(0, len(sites), n_rows)
+    landed = np.char.startswith(outcome.astype(str), 'True')
+    return pd.DataFrame({'FlightNumber': np.arange(1, n_rows+1),
+                         'Date': (np.datetime64('2010-06-04')+rng.integers(0, 3800, n_rows)).astype(str),
+                         'BoosterVersion': 'Falcon 9',
+                         'PayloadMass': np.round(rng.uniform(350, 15600, n_rows), 2),
+                         'Orbit': np.array(['LEO', 'ISS', 'PO', 'GTO', 'ES-L1', 'SSO', 'HEO', 'MEO', 'VLEO', 'SO', 'GEO'])[rng.integers(0, 11, n_rows)],
+                         'LaunchSite': sites[site],
+                         'Outcome': outcome,
+                         'Flights': rng.integers(1, 7, n_rows),
+                         'GridFins': rng.random(n_rows) < 0.8,
+                         'Reused': rng.random(n_rows) < 0.4,
+                         'Legs': rng.random(n_rows) < 0.8,
+                         'LandingPad': np.where(landed, np.array(['5e9e3032383ecb267a34e7c7', '5e9e3032383ecb6bb234e7ca', '5e9e3033383ecbb9e534e7cc'], dtype=object)[site], None),
+                         'Block': rng.integers(1, 6, n_rows).astype(np.float64),
+                         'ReusedCount': rng.integers(0, 13, n_rows),
+                         'Serial': np.char.add('B', rng.integers(1000, 1063, n_rows).astype(str)).astype(object),
+                         'Longitude': np.array([-80.577366, -80.603956, -120.610829])[site],
+                         'Latitude': np.array([28.5618571, 28.6080585, 34.632093])[site],
+                         'Class': decode_landing_class(pd.Series(outcome)).to_numpy()})
+
+
+# The EDA and SQL labs need the year and month of every launch. <code>add_date_features</code> parses the <code>Date</code> column into <code>datetime64</code> once and adds <code>Year</code>, <code>Month</code> and <code>DayOfYear</code> columns computed from it for all rows at once. Each distinct date is only parsed once, which matters when there are far fewer dates than rows, and a data frame whose <code>Date</code> is already parsed and that already has the three columns is returned as it is, so calling it again costs nothing.
+# 
+
+# In[ ]:
+
+
+# Takes a data frame with a Date column and adds the parsed dates and their Year, Month and DayOfYear, reusing them when they were added before
+def add_date_features(df, column='Date', format=None):
+    if pd.api.types.is_datetime64_any_dtype(df[column]) and {'Year', 'Month', 'DayOfYear'}.issubset(df.columns):
+        return df
+    # Every distinct date is parsed once, and the dates and their features are spread over the rows by the code of their date
+    if isinstance(df[column].dtype, pd.CategoricalDtype):
+        codes, uniques = df[column].cat.codes.to_numpy(), df[column].cat.categories
+    else:
+        codes, uniques = pd.factorize(df[column])
+    uniques = pd.DatetimeIndex(pd.to_datetime(uniques, format=format))
+    missing = (codes < 0).any()
+    # A missing date has the code -1, which picks the missing value appended at the end
+    def spread(values):
+        return np.append(values.astype(np.float64), np.nan)[codes] if missing else values[codes]
+    df[column] = np.append(uniques.to_numpy(), np.datetime64('NaT'))[codes]
+    df['Year'] = spread(uniques.year.to_numpy())
+    df['Month'] = spread(uniques.month.to_numpy())
+    df['DayOfYear'] = spread(uniques.dayofyear.to_numpy())
+    return df
+
+
 # # TASK 1: Calculate the number of launches on each site
 # 
 # The data contains several Space X  launch facilities: <a href='https://en.wikipedia.org/wiki/List_of_Cape_Canaveral_and_Merritt_Island_launch_sites'>Cape Canaveral Space</a> Launch Complex 40  <b>VAFB SLC 4E </b> , Vandenberg Air Force Base Space Launch Complex 4E <b>(SLC-4E)</b>, Kennedy Space Center Launch Complex 39A <b>KSC LC 39A </b>.The location of each Launch Is placed in the column <code>LaunchSite</code>
@@ -554,6 +1559,35 @@ bad_outcomes
 # landing_class = 1 otherwise
 
 
+# Picking the bad outcomes by their position in <code>value_counts</code> only works as long as the counts keep the same order. <code>landing_outcome_class</code> instead lists the class of every outcome explicitly, and <code>decode_landing_class</code> turns the <code>Outcome</code> column into a categorical column and looks up the class of each category once, so the labels are the same whatever the order of the counts and millions of rows take milliseconds. An outcome that is not in the table raises an error instead of being labelled silently.
+# 
+
+# In[ ]:
+
+
+# The landing class of every outcome, 1 when the first stage landed and 0 when it did not
+landing_outcome_class = {'True ASDS': 1,
+'True RTLS': 1,
+'True Ocean': 1,
+'False ASDS': 0,
+'False RTLS': 0,
+'False Ocean': 0,
+'None ASDS': 0,
+'None None': 0}
+bad_outcomes = {outcome for outcome, landed in landing_outcome_class.items() if not landed}
+
+# Takes the Outcome column and returns the landing class of every row
+def decode_landing_class(outcome):
+    outcome = outcome.astype('category')
+    classes = outcome.cat.categories.map(landing_outcome_class)
+    unknown = outcome.cat.categories[classes.isna()]
+    if len(unknown) or outcome.isna().any():
+        raise ValueError("Outcomes without a landing class: %s" % list(unknown) if len(unknown) else "Missing outcomes")
+    return pd.Series(classes.to_numpy(dtype=np.int64)[outcome.cat.codes.to_numpy()], index=outcome.index, name='Class')
+
+landing_class = decode_landing_class(df['Outcome'])
+
+
 # This variable will represent the classification variable that represents the outcome of each launch. If the value is zero, the  first stage did not land successfully; one means  the first stage landed Successfully 
 # 
 
@@ -588,6 +1622,15 @@ df["Class"].mean()
 <code>df.to_csv("dataset_part_2.csv", index=False)</code>
 
 
+# or, keeping the data types, with <code>writeDataset</code>, which the next lab reads first:
+# 
+
+# In[ ]:
+
+
+writeDataset(df, 'dataset_part_2')
+
+
 # # Introduction
 
 # Using this python notebook you will:
@@ -666,12 +1709,120 @@ get_ipython().system('pip install -q pandas==1.1.5')
 get_ipython().run_line_magic('sql', 'sqlite:///my_data1.db')
 
 
+# <code>to_sql</code> with <code>method="multi"</code> builds INSERT statements with many rows each through pandas and commits them with the default journal, which is slow for large tables and fails once a statement needs more variables than SQLite allows. <code>bulk_load_table</code> creates the table itself, with the SQLite type of every column given by <code>spacex_column_types</code> so each column gets an explicit affinity, and streams the rows in with <code>executemany</code>, one transaction per <code>chunk_size</code> rows. While it loads, the PRAGMAs in <code>load_pragmas</code> switch the journal to WAL, stop waiting for every write to reach the disk and enlarge the page cache; the previous settings are restored afterwards.
+# 
+# Picking the year and month out of the text of every date with <code>substr</code>, or comparing dates as text, cannot use an index. The dates are therefore also loaded as the integer <code>Date_Key</code>, for example 20150110, which sorts like the dates, and <code>create_spacex_table</code> makes <code>SPACEXTABLE</code> with <code>Year</code> and <code>Month</code> columns generated from it. Generated columns can be indexed, so a query for the launches of 2015 or between two dates becomes a range search of an index.
+# 
+# <code>make_synthetic_spacex_table</code> makes up a table with the columns of <code>Spacex.csv</code> of any size, and <code>benchmark_sql_load</code> times both ways of loading it.
+# 
+
+# In[ ]:
+
+
+# The SQLite type of each column of SPACEXTBL, other columns get a type from their pandas dtype
+spacex_column_types = {'Date': 'TEXT',
+'Time (UTC)': 'TEXT',
+'Booster_Version': 'TEXT',
+'Launch_Site': 'TEXT',
+'Payload': 'TEXT',
+'PAYLOAD_MASS__KG_': 'INTEGER',
+'Orbit': 'TEXT',
+'Customer': 'TEXT',
+'Mission_Outcome': 'TEXT',
+'Landing_Outcome': 'TEXT',
+'Date_Key': 'INTEGER'}
+# The PRAGMAs set while a table is loaded
+load_pragmas = {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -256000, 'temp_store': 'MEMORY'}
+
+# Takes a column and returns the SQLite type it is stored as
+def column_type(name, column):
+    if name in spacex_column_types:
+        return spacex_column_types[name]
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_integer_dtype(column):
+        return 'INTEGER'
+    return 'REAL' if pd.api.types.is_float_dtype(column) else 'TEXT'
+
+# Takes a column and returns its values as Python objects sqlite3 can bind, dates as text and missing values as None
+def column_values(column):
+    if pd.api.types.is_datetime64_any_dtype(column):
+        column = column.dt.strftime('%Y-%m-%d')
+    if column.hasnans:
+        return column.astype(object).where(column.notna(), None).tolist()
+    return column.tolist()
+
+# Takes a connection, a data frame and a table name and loads the rows into the table with executemany, committing every chunk_size rows
+def bulk_load_table(con, df, table, if_exists='replace', chunk_size=100000, pragmas=load_pragmas):
+    previous = {pragma: con.execute('PRAGMA %s' % pragma).fetchone()[0] for pragma in pragmas}
+    for pragma, value in pragmas.items():
+        con.execute('PRAGMA %s = %s' % (pragma, value))
+    try:
+        with con:
+            if if_exists == 'replace':
+                con.execute('DROP TABLE IF EXISTS "%s"' % table)
+            con.execute('CREATE TABLE IF NOT EXISTS "%s" (%s)' % (table, ', '.join('"%s" %s' % (name, column_type(name, column)) for name, column in df.items())))
+        insert = 'INSERT INTO "%s" (%s) VALUES (%s)' % (table, ', '.join('"%s"' % name for name in df.columns), ', '.join('?'*len(df.columns)))
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start:start+chunk_size]
+            with con:
+                con.executemany(insert, zip(*[column_values(column) for _, column in chunk.items()]))
+    finally:
+        for pragma, value in previous.items():
+            con.execute('PRAGMA %s = %s' % (pragma, value))
+    return len(df)
+
+# Takes a connection and copies the launches that have a date from SPACEXTBL into SPACEXTABLE, where Year and Month are generated from Date_Key
+def create_spacex_table(con, source='SPACEXTBL', table='SPACEXTABLE'):
+    columns = [(name, declared_type) for _, name, declared_type, _, _, _ in con.execute('PRAGMA table_info("%s")' % source)]
+    names = ', '.join('"%s"' % name for name, _ in columns)
+    with con:
+        con.execute('DROP TABLE IF EXISTS "%s"' % table)
+        con.execute('CREATE TABLE "%s" (%s, "Year" INTEGER GENERATED ALWAYS AS ("Date_Key" / 10000) VIRTUAL, "Month" INTEGER GENERATED ALWAYS AS ("Date_Key" / 100 %% 100) VIRTUAL)'
+                    % (table, ', '.join('"%s" %s' % column for column in columns)))
+        con.execute('INSERT INTO "%s" (%s) SELECT %s FROM "%s" WHERE "Date" IS NOT NULL' % (table, names, names, source))
+
+# Takes a number of rows and returns a made up table with the columns of Spacex.csv
+def make_synthetic_spacex_table(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    def pick(values):
+        return np.array(values, dtype=object)[rng.integers(0, len(values), n_rows)]
+    dates = pd.DatetimeIndex(np.datetime64('2010-06-04')+rng.integers(0, 3800, n_rows))
+    return pd.DataFrame({'Date': dates.strftime('%Y-%m-%d').astype(object),
+                         'Date_Key': dates.year*10000+dates.month*100+dates.day,
+                         'Time (UTC)': pick(['18:45:00', '15:43:00', '07:44:00', '00:35:00', '22:41:00']),
+                         'Booster_Version': pick(['F9 v1.0  B0003', 'F9 v1.1', 'F9 v1.1 B1011', 'F9 FT B1019', 'F9 FT B1021.1', 'F9 B4 B1039.2', 'F9 B5 B1048.4', 'F9 B5 B1049.4']),
+                         'Launch_Site': pick(['CCAFS LC-40', 'CCAFS SLC-40', 'KSC LC-39A', 'VAFB SLC-4E']),
+                         'Payload': pick(['Dragon Spacecraft Qualification Unit', 'SpaceX CRS-1', 'Starlink 1 v1.0', 'SES-8', 'Iridium NEXT 1']),
+                         'PAYLOAD_MASS__KG_': rng.integers(0, 15600, n_rows),
+                         'Orbit': pick(['LEO', 'LEO (ISS)', 'GTO', 'PO', 'SSO', 'HEO', 'MEO']),
+                         'Customer': pick(['SpaceX', 'NASA (COTS) NRO', 'NASA (CRS)', 'SES', 'Iridium Communications', 'Thaicom']),
+                         'Mission_Outcome': pick(['Success', 'Success', 'Success', 'Failure (in flight)', 'Success (payload status unclear)']),
+                         'Landing_Outcome': pick(['Failure (parachute)', 'No attempt', 'Controlled (ocean)', 'Success (drone ship)', 'Success (ground pad)', 'Failure (drone ship)', 'Uncontrolled (ocean)', 'Success', 'Failure'])})
+
+# Takes a number of rows and returns the seconds to_sql and bulk_load_table take to load a synthetic table of that size into a new database
+def benchmark_sql_load(n_rows=10000000, seed=0):
+    df = make_synthetic_spacex_table(n_rows, seed)
+    loaders = {'to_sql': lambda con: df.to_sql("SPACEXTBL", con, if_exists='replace', index=False, method="multi", chunksize=999//len(df.columns)),
+               'bulk_load_table': lambda con: bulk_load_table(con, df, "SPACEXTBL")}
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, load in loaders.items():
+            con = sqlite3.connect(os.path.join(directory, name+'.db'))
+            start = time.perf_counter()
+            load(con)
+            results.append({'loader': name, 'rows': n_rows, 'seconds': time.perf_counter()-start})
+            con.close()
+    return pd.DataFrame(results)
+
+
 # In[49]:
 
 
 import pandas as pd
-df = pd.read_csv("https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/labs/module_2/data/Spacex.csv")
-df.to_sql("SPACEXTBL", con, if_exists='replace', index=False,method="multi")
+df = add_date_features(readRemoteDataset("https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/labs/module_2/data/Spacex.csv"))
+# The dates are stored as text, and as the integer Date_Key, YYYYMMDD, which sorts like the dates and is compared without any string work
+df['Date_Key'] = (df['Year']*10000+df['Month']*100+df['Date'].dt.day).astype('Int64')
+with instrumentStage('bulk_load_table', len(df)):
+    bulk_load_table(con, df.drop(columns=['Year', 'Month', 'DayOfYear']), "SPACEXTBL")
 
 
 # # **Note:This below code is added to remove blank rows from table**
@@ -680,7 +1831,7 @@ df.to_sql("SPACEXTBL", con, if_exists='replace', index=False,method="multi")
 # In[ ]:
 
 
-get_ipython().run_line_magic('sql', 'create table SPACEXTABLE as select * from SPACEXTBL where Date is not null')
+create_spacex_table(con)
 
 
 # # Tasks
@@ -764,6 +1915,104 @@ get_ipython().run_line_magic('sql', 'create table SPACEXTABLE as select * from S
 # ##### Rank the count of landing outcomes (such as Failure (drone ship) or Success (ground pad)) between the date 2010-06-04 and 2017-03-20, in descending order.
 # 
 
+# ### Summary tables
+# 
+# Task 1 lists the launch sites and tasks 3, 4, 7 and 10 add up payload masses and count launches over all of <code>SPACEXTABLE</code>. <code>create_spacex_summaries</code> keeps these totals in small tables instead: the launches, the launches with a payload mass and the total payload mass for each launch site, each customer, each booster version, each mission outcome and each landing outcome on each day. Each table is filled from the rows already in <code>SPACEXTABLE</code>, and a trigger adds every row inserted afterwards, so the tasks read one row per launch site, customer, booster version or outcome rather than every launch. The triggers only follow inserts, so <code>create_spacex_summaries</code> has to be run again after rows are updated or deleted, or after <code>create_spacex_table</code> builds the table again.
+# 
+
+# In[ ]:
+
+
+# The summary tables of SPACEXTABLE and the columns each one groups the launches by
+spacex_summaries = {'launch_site_summary': ['Launch_Site'],
+'customer_summary': ['Customer'],
+'booster_version_summary': ['Booster_Version'],
+'mission_outcome_summary': ['Mission_Outcome'],
+'landing_outcome_summary': ['Date_Key', 'Landing_Outcome']}
+
+# Takes a connection and creates the summary tables from the rows of the table, with the triggers that add every row inserted later
+def create_spacex_summaries(con, table='SPACEXTABLE', summaries=spacex_summaries, mass='PAYLOAD_MASS__KG_'):
+    types = {name: declared_type for _, name, declared_type, _, _, _ in con.execute('PRAGMA table_info("%s")' % table)}
+    with con:
+        for summary, keys in summaries.items():
+            columns = ', '.join('"%s"' % key for key in keys)
+            new_columns = ', '.join('NEW."%s"' % key for key in keys)
+            # IS also matches the launches where the column is missing, which GROUP BY puts in a group of their own
+            matches = ' AND '.join('"%s" IS NEW."%s"' % (key, key) for key in keys)
+            con.execute('DROP TABLE IF EXISTS "%s"' % summary)
+            con.execute('CREATE TABLE "%s" (%s, "Launches" INTEGER NOT NULL, "Payload_Launches" INTEGER NOT NULL, "Payload_Mass" %s, UNIQUE (%s))'
+                        % (summary, ', '.join('"%s" %s' % (key, types[key]) for key in keys), types[mass], columns))
+            con.execute('INSERT INTO "%s" SELECT %s, COUNT(*), COUNT("%s"), SUM("%s") FROM "%s" GROUP BY %s' % (summary, columns, mass, mass, table, columns))
+            con.execute('DROP TRIGGER IF EXISTS "%s_insert"' % summary)
+            # The row of the group is updated, and a new one is inserted only when changes() tells there is none yet
+            # Payload_Mass stays NULL until a launch with a payload mass is added, like SUM over launches without one
+            con.execute('CREATE TRIGGER "%s_insert" AFTER INSERT ON "%s" BEGIN '
+                        'UPDATE "%s" SET "Launches" = "Launches"+1, "Payload_Launches" = "Payload_Launches"+(NEW."%s" IS NOT NULL), '
+                        '"Payload_Mass" = COALESCE("Payload_Mass"+NEW."%s", "Payload_Mass", NEW."%s") WHERE %s; '
+                        'INSERT INTO "%s" SELECT %s, 1, NEW."%s" IS NOT NULL, NEW."%s" WHERE changes() = 0; END'
+                        % (summary, table, summary, mass, mass, mass, matches, summary, new_columns, mass, mass))
+
+create_spacex_summaries(con)
+
+
+# ### Indexes for the tasks
+# 
+# Without indexes every task reads the whole of <code>SPACEXTABLE</code>. <code>create_spacex_indexes</code> creates one index for each way the tasks look rows up: by launch site, by landing outcome together with the date, the year or the payload mass, and by payload mass. Tasks 1, 3, 4, 7 and 10 read the summary tables, which are looked up through their own <code>UNIQUE</code> index. The columns a task reads are added to the end of its index, so the task is answered from the index alone. <code>LIKE</code> ignores case in SQLite, so the prefix <code>LIKE 'CCA%'</code> can only use an index that ignores case too, which is why the launch site index uses <code>COLLATE NOCASE</code>.
+# 
+# <code>check_query_plans</code> runs <code>EXPLAIN QUERY PLAN</code> for the statement of every task in <code>spacex_queries.statements</code>, the module described below, with the parameters of the examples in <code>spacex_queries.example_parameters</code>, and raises an error naming the tasks that read the table row by row. Listing every launch site and counting every mission outcome have to visit every group, so for them a scan of <code>launch_site_summary</code> and <code>mission_outcome_summary</code> is accepted, which have one row for each launch site and each outcome.
+# 
+
+# In[ ]:
+
+
+import spacex_queries
+
+# The indexes of SPACEXTABLE and the columns of each one
+spacex_indexes = {'idx_launch_site': '"Launch_Site" COLLATE NOCASE',
+'idx_landing_outcome_date': '"Landing_Outcome", "Date"',
+'idx_landing_outcome_year': '"Landing_Outcome", "Year", "Month", "Booster_Version", "Launch_Site"',
+'idx_landing_outcome_payload': '"Landing_Outcome", "PAYLOAD_MASS__KG_", "Booster_Version"',
+'idx_payload': '"PAYLOAD_MASS__KG_", "Booster_Version"'}
+# Tasks that have to visit every group, for which a scan of a summary table is accepted
+full_scan_tasks = {'task_1', 'task_7'}
+
+# Takes a connection and creates the indexes of the tasks, then gathers the statistics the query planner uses to choose between them
+def create_spacex_indexes(con, table='SPACEXTABLE', indexes=spacex_indexes):
+    with con:
+        for name, columns in indexes.items():
+            con.execute('CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % (name, table, columns))
+    # Sampling 1000 rows per index keeps ANALYZE fast on large tables
+    con.execute('PRAGMA analysis_limit = 1000')
+    con.execute('ANALYZE "%s"' % table)
+    con.commit()
+
+# Takes a connection and returns the query plan of every task, raising an error when a task reads a table row by row
+def check_query_plans(con, queries=spacex_queries.statements, parameters=spacex_queries.example_parameters, allowed_scans=full_scan_tasks, summaries=spacex_summaries):
+    plans = {task: [row[3] for row in con.execute('EXPLAIN QUERY PLAN '+query, parameters.get(task, ()))] for task, query in queries.items()}
+    scans = [task for task, plan in plans.items()
+             if any(step.startswith('SCAN') and not (task in allowed_scans and step.split()[1] in summaries) for step in plan)]
+    if scans:
+        raise AssertionError("Tasks that scan the table: %s" % {task: plans[task] for task in scans})
+    return plans
+
+create_spacex_indexes(con)
+check_query_plans(con)
+
+
+# The tasks are also available as functions in <code>spacex_queries.py</code>, next to this notebook, so the dashboard and reports can run them with their own parameters. Their SQL is only written in the module, whose statements are the ones checked above. The module keeps one connection open, runs each task as a statement with <code>?</code> parameters that SQLite compiles once, and caches the results, so asking the same question again only looks it up in a dictionary. Any change committed to the database empties the cache by itself, whether it is made through the module's connection or another one, such as <code>con</code> when the table is loaded again.
+# 
+
+# In[ ]:
+
+
+import spacex_queries
+
+spacex_queries.connect("my_data1.db")
+print(spacex_queries.unique_launch_sites())
+print(spacex_queries.total_payload_mass('NASA (CRS)'))
+print(spacex_queries.rank_landing_outcomes('2010-06-04', '2017-03-20'))
+
+
 # # **SpaceX  Falcon 9 First Stage Landing Prediction**
 # 
 
@@ -811,7 +2060,7 @@ import seaborn as sns
 # In[59]:
 
 
-df=pd.read_csv("https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/dataset_part_2.csv")
+df=readStageDataset('dataset_part_2', "https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/dataset_part_2.csv")
 
 # If you were unable to complete the previous lab correctly you can uncomment and load this csv
 
@@ -820,6 +2069,16 @@ df=pd.read_csv("https://cf-courses-data.s3.us.cloud-object-storage.appdomain.clo
 df.head(5)
 
 
+# The launches are grouped by orbit, launch site and year below, so their data types are compacted first with <code>compact_dtypes</code> from the wrangling lab.
+# 
+
+# In[ ]:
+
+
+df, dtype_report = compact_dtypes(df)
+dtype_report
+
+
 # First, let's try to see how the `FlightNumber` (indicating the continuous launch attempts.) and `Payload` variables would affect the launch outcome.
 # 
 # We can plot out the <code>FlightNumber</code> vs. <code>PayloadMass</code>and overlay the outcome of the launch. We see that as the flight number increases, the first stage is more likely to land successfully. The payload mass is also important; it seems the more massive the payload, the less likely the first stage will return.
@@ -925,23 +2184,26 @@ plt.show()
 # 
 # The function will help you get the year from the date:
 # 
+# It parses its own copy of the dates every time it is called. The chart below instead adds the <code>Year</code> column to <code>df</code> once with <code>add_date_features</code> and groups by it, and <code>Extract_year</code> is only kept for code that still calls it.
+# 
 
 # In[66]:
 
 
-# A function to Extract years from the date 
-year=[]
+# A function to Extract years from the date, returning the year of every date as text without changing df
 def Extract_year(date):
-    for i in df["Date"]:
-        year.append(i.split("-")[0])
-    return year
-    
+    return add_date_features(pd.DataFrame({'Date': date}))['Year'].astype('Int64').astype(str).tolist()
 
 
 # In[67]:
 
 
 # Plot a line chart with x axis to be the extracted year and y axis to be the success rate
+df = add_date_features(df)
+sns.lineplot(x='Year', y='Class', data=df.groupby('Year', as_index=False)['Class'].mean())
+plt.xlabel("Year", fontsize=20)
+plt.ylabel("Success rate", fontsize=20)
+plt.show()
 
 
 # You can observe that the success rate since 2013 kept increasing till 2017 (stable in 2014) and after 2015 it started increasing.
@@ -989,6 +2251,15 @@ features.head()
 
 # <code>features_one_hot.to_csv('dataset_part_3.csv', index=False)</code>
 # 
+# or, keeping the data types, with <code>writeDataset</code>, which the machine learning lab reads first:
+# 
+
+# In[ ]:
+
+
+if 'features_one_hot' in globals():
+    writeDataset(features_one_hot, 'dataset_part_3')
+
 
 # # **Launch Sites Locations Analysis with Folium**
 # 
@@ -1017,14 +2288,12 @@ features.head()
 
 
 get_ipython().system('pip3 install folium')
-get_ipython().system('pip3 install wget')
 
 
 # In[73]:
 
 
 import folium
-import wget
 import pandas as pd
 
 
@@ -1055,8 +2324,7 @@ from folium.features import DivIcon
 
 
 # Download and read the `spacex_launch_geo.csv`
-spacex_csv_file = wget.download('https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/spacex_launch_geo.csv')
-spacex_df=pd.read_csv(spacex_csv_file)
+spacex_df=readStageDataset('spacex_launch_geo', 'https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/spacex_launch_geo.csv')
 
 
 # Now, you can take a look at what are the coordinates for each site.
@@ -1221,10 +2489,11 @@ site_map.add_child(marker_cluster)
 # create a Marker object with its coordinate
 # and customize the Marker's icon property to indicate if this launch was successed or failed, 
 # e.g., icon=folium.Icon(color='white', icon_color=row['marker_color']
-for index, record in spacex_df.iterrows():
-    # TODO: Create and add a Marker cluster to the site map
-    # marker = folium.Marker(...)
-    marker_cluster.add_child(marker)
+with instrumentStage('folium_markers', len(spacex_df)):
+    for index, record in spacex_df.iterrows():
+        # TODO: Create and add a Marker cluster to the site map
+        # marker = folium.Marker(...)
+        marker_cluster.add_child(marker)
 
 site_map
 
@@ -1409,6 +2678,16 @@ python3.11 -m pip install pandas dash
 # 1
 # wget "https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/spacex_launch_dash.csv"
 # Copied!
+# 
+# Or save it next to the other datasets with its data types, and read it in spacex_dash_app.py with <code>spacex_df = pd.read_feather('spacex_launch_dash.feather')</code>:
+# 
+
+# In[ ]:
+
+
+spacex_dash_df = readStageDataset('spacex_launch_dash', "https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/spacex_launch_dash.csv")
+
+
 # Download a skeleton Dash app to be completed in this lab:
 # 1
 # wget "https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/labs/module_3/spacex_dash_app.py"
@@ -1722,13 +3001,8 @@ def plot_confusion_matrix(y,y_predict):
 # In[ ]:
 
 
-from js import fetch
-import io
-
 URL1 = "https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/dataset_part_2.csv"
-resp1 = await fetch(URL1)
-text1 = io.BytesIO((await resp1.arrayBuffer()).to_py())
-data = pd.read_csv(text1)
+data = readStageDataset('dataset_part_2', URL1)
 
 
 # In[ ]:
@@ -1747,9 +3021,8 @@ data.head()
 
 
 URL2 = 'https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/dataset_part_3.csv'
-resp2 = await fetch(URL2)
-text2 = io.BytesIO((await resp2.arrayBuffer()).to_py())
-X = pd.read_csv(text2)
+# The dataset_part_3 written in the previous lab is read when there is one, a Feather file is memory mapped so the feature columns are not copied
+X = readStageDataset('dataset_part_3', URL2)
 
 
 # In[ ]:
@@ -1976,3 +3249,321 @@ plot_confusion_matrix(Y_test,yhat)
 
 
 
+# ## Running the capstone as a pipeline
+# 
+# Every run of the labs repeats every step, from calling the API to fitting the four grid searches, even when nothing they depend on has changed. Below, the capstone is written as a chain of stages run through <code>run_stage</code>. The output of each stage is saved in <code>stage_cache</code> under a hash of the stage's name, its code, the code of the functions of this notebook it calls and the settings they read, such as <code>landing_outcome_class</code> or <code>payload_mass_groups</code>, its parameters and the hashes of the stages it takes its inputs from. The first stage takes the content of the launches file rather than its url, so a new version of the file runs the capstone again. When a stage is run again with the same hash, its saved output is used instead, and its inputs are not even loaded. Changing only the SVM grid therefore changes only the hash of the <code>svm</code> stage, and only the SVM search is run again.
+# 
+
+# In[ ]:
+
+
+import inspect
+import pickle
+
+stage_cache_dir = 'stage_cache'
+# The hash of every stage that has been run, and its output or the file its output is saved in
+stage_hashes = {}
+stage_outputs = {}
+# Global variables the stages read that are left out of their hash: the caches and state of the run, and the settings of how
+# data is fetched, cached and measured, which change how long a stage takes but not what it returns
+stage_hash_exclude = {'entity_cache', 'http_cache_index', 'dataset_checksums', 'cassette', 'stage_hashes', 'stage_outputs',
+                      'instrument_records', 'instrument_peaks', 'instrument_run_id',
+                      'spacex_api_url', 'http_timeout', 'http_cache_dir', 'entity_cache_path', 'entity_cache_ttl', 'entity_cache_size',
+                      'bulk_page_size', 'dataset_offline', 'cassette_path', 'stage_cache_dir',
+                      'instrument_enabled', 'instrument_tracemalloc', 'instrument_tracing', 'instrument_report_path'}
+
+# Takes a value and returns a hash of its content, data frames and arrays are hashed from their data
+def content_hash(value, h=None):
+    top = h is None
+    h = h or hashlib.sha256()
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(repr((type(value).__name__, value.shape, value.dtypes.to_dict() if isinstance(value, pd.DataFrame) else value.dtype)).encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        h.update(repr((value.dtype, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes() if value.dtype != object else repr(value.tolist()).encode())
+    elif isinstance(value, dict):
+        h.update(b'{')
+        for key in sorted(value, key=repr):
+            content_hash(key, h)
+            content_hash(value[key], h)
+        h.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for item in value:
+            content_hash(item, h)
+        h.update(b']')
+    elif isinstance(value, (set, frozenset)):
+        # The order of a set changes from one Python process to the next
+        content_hash(sorted(value, key=repr), h)
+    elif isinstance(value, bytes):
+        h.update(value)
+    elif callable(value) and hasattr(value, '__code__'):
+        try:
+            h.update(inspect.getsource(value).encode())
+        except (OSError, TypeError):
+            h.update(value.__qualname__.encode())
+        # Default values such as by=payload_mass_groups are taken when the function is defined and are not in its source
+        content_hash([inspect.unwrap(value).__defaults__, inspect.unwrap(value).__kwdefaults__], h)
+    else:
+        h.update(repr(value).encode())
+    return h.hexdigest() if top else h
+
+# Takes a function and returns the functions of this notebook it calls, directly or through other functions, and the settings they read, by name
+def stage_dependencies(func, found=None):
+    found = {} if found is None else found
+    # The code of a decorated function is in the function it wraps, and comprehensions and inner functions have code of their own
+    codes = [inspect.unwrap(func).__code__, func.__code__]
+    while codes:
+        code = codes.pop()
+        codes.extend(const for const in code.co_consts if inspect.iscode(const))
+        for name in code.co_names:
+            value = func.__globals__.get(name)
+            if name in found or name in stage_hash_exclude:
+                continue
+            if inspect.isfunction(value) and value.__globals__ is func.__globals__:
+                found[name] = value
+                stage_dependencies(value, found)
+            elif type(value) in (dict, list, tuple, set, frozenset, str, int, float, bool):
+                found[name] = value
+    return found
+
+# Takes the name of a stage that has been run and returns its output, loading it from the stage cache if needed
+def stage_output(name):
+    if isinstance(stage_outputs[name], str):
+        with open(stage_outputs[name], 'rb') as f:
+            stage_outputs[name] = pickle.load(f)
+    return stage_outputs[name]
+
+# Runs func with the outputs of the upstream stages followed by the parameters, unless the stage has already been run with the same hash
+def run_stage(name, func, upstream=(), **params):
+    stage_hash = content_hash([name, func, stage_dependencies(func), params, [stage_hashes[stage] for stage in upstream]])
+    path = os.path.join(stage_cache_dir, name+'-'+stage_hash[:16]+'.pkl')
+    stage_hashes[name] = stage_hash
+    if os.path.exists(path):
+        stage_outputs[name] = path
+        return stage_hash
+    inputs = [stage_output(stage) for stage in upstream]
+    with instrumentStage(name, instrumentRows(inputs[0]) if inputs else None) as record:
+        output = func(*inputs, **params)
+        if record.get('rows') is None:
+            record['rows'] = instrumentRows(output)
+    os.makedirs(stage_cache_dir, exist_ok=True)
+    with open(path+'.tmp', 'wb') as f:
+        pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path+'.tmp', path)
+    stage_outputs[name] = output
+    return stage_hash
+
+
+# The stages of the capstone. Each one takes the outputs of the stages before it and returns its own output.
+# 
+
+# In[ ]:
+
+
+# Lab 1: takes the content of the launches file, enriches the launches with the API and returns the Falcon 9 launches with missing payload masses replaced by the mean of their group
+def make_dataset_part_1(launches, last_date):
+    launches = json.loads(launches)
+    with instrumentStage('json_normalize', len(launches)):
+        data = selectLaunches(pd.json_normalize(launches), last_date)
+    launches = buildLaunchFrame(data)
+    data_falcon9 = launches[launches['BoosterVersion']!='Falcon 1'].reset_index(drop=True)
+    data_falcon9['FlightNumber'] = np.arange(1, len(data_falcon9)+1)
+    return imputePayloadMass(data_falcon9)
+
+# Lab 2: adds the Class label, 0 when the first stage did not land and 1 when it did
+def make_dataset_part_2(dataset_part_1):
+    df = dataset_part_1.copy()
+    df['Class'] = decode_landing_class(df['Outcome'])
+    return df
+
+# EDA: selects the features, one hot encodes the categorical ones and casts everything to float64
+def make_dataset_part_3(dataset_part_2):
+    features = dataset_part_2[['FlightNumber', 'PayloadMass', 'Orbit', 'LaunchSite', 'Flights', 'GridFins', 'Reused', 'Legs', 'LandingPad', 'Block', 'ReusedCount', 'Serial']]
+    return pd.get_dummies(features, columns=['Orbit', 'LaunchSite', 'LandingPad', 'Serial']).astype('float64')
+
+# Machine learning: standardizes the features and splits them and the labels into training and test data
+def split_dataset(dataset_part_2, dataset_part_3, test_size, random_state):
+    X = preprocessing.StandardScaler().fit_transform(dataset_part_3)
+    Y = dataset_part_2['Class'].to_numpy()
+    return train_test_split(X, Y, test_size=test_size, random_state=random_state)
+
+# Machine learning: fits a grid search of the estimator on the training data
+def fit_grid_search(split, estimator, parameters, cv):
+    X_train, X_test, Y_train, Y_test = split
+    return GridSearchCV(estimator, parameters, cv=cv).fit(X_train, Y_train)
+
+
+# <code>run_capstone</code> runs the stages in order and returns the four fitted grid searches. Pass a different grid, for example <code>svm_parameters</code>, to run only the stages that depend on it again. The timings of the stages that ran are written to <code>capstone_report.json</code>.
+# 
+
+# In[ ]:
+
+
+def run_capstone(url='https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-DS0321EN-SkillsNetwork/datasets/API_call_spacex_api.json',
+                 last_date=datetime.date(2020, 11, 13),
+                 logreg_parameters={'C': [0.01, 0.1, 1], 'penalty': ['l2'], 'solver': ['lbfgs']},
+                 svm_parameters={'kernel': ('linear', 'rbf', 'poly', 'rbf', 'sigmoid'), 'C': np.logspace(-3, 3, 5), 'gamma': np.logspace(-3, 3, 5)},
+                 tree_parameters={'criterion': ['gini', 'entropy'], 'splitter': ['best', 'random'], 'max_depth': [2*n for n in range(1, 10)],
+                                  'max_features': ['auto', 'sqrt'], 'min_samples_leaf': [1, 2, 4], 'min_samples_split': [2, 5, 10]},
+                 knn_parameters={'n_neighbors': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 'algorithm': ['auto', 'ball_tree', 'kd_tree', 'brute'], 'p': [1, 2]}):
+    startInstrumentRun()
+    run_stage('dataset_part_1', make_dataset_part_1, launches=fetchDataset(url), last_date=last_date)
+    run_stage('dataset_part_2', make_dataset_part_2, upstream=['dataset_part_1'])
+    run_stage('dataset_part_3', make_dataset_part_3, upstream=['dataset_part_2'])
+    run_stage('split', split_dataset, upstream=['dataset_part_2', 'dataset_part_3'], test_size=0.2, random_state=2)
+    models = {'logreg': (LogisticRegression(), logreg_parameters),
+              'svm': (SVC(), svm_parameters),
+              'tree': (DecisionTreeClassifier(), tree_parameters),
+              'knn': (KNeighborsClassifier(), knn_parameters)}
+    for name, (estimator, parameters) in models.items():
+        run_stage(name, fit_grid_search, upstream=['split'], estimator=estimator, parameters=parameters, cv=10)
+    writeInstrumentReport()
+    return {name: stage_output(name) for name in models}
+
+
+# In[ ]:
+
+
+models = run_capstone()
+for name, model in models.items():
+    print(name, model.best_params_, model.best_score_)
+
+
+# ### Processing datasets larger than memory
+# 
+# The stages above read the whole of <code>dataset_part_1</code> into memory, which is fine for the real launches but not for launch histories larger than the memory of the machine, such as many synthetic scenarios replayed into one dataset. <code>process_dataset_chunks</code> runs the wrangling, labelling and feature engineering stages over the dataset in chunks of <code>chunk_size</code> rows instead, so the memory it needs is set by the chunk size and not by the size of the dataset.
+# 
+# It reads the dataset twice. The first scan adds up the payload mass statistics, the value counts of the wrangling lab and the number of landings, and collects the values of the one hot encoded columns. The second scan fills the missing payload masses, adds the <code>Class</code> label and encodes the features of every chunk, writing <code>dataset_part_2</code> and <code>dataset_part_3</code> as it goes. Every chunk is encoded with the values of the whole dataset, so all chunks get the same columns, in the same order as <code>make_dataset_part_3</code>.
+# 
+
+# In[ ]:
+
+
+# Feature engineering for one chunk, encoded with the values of every categorical column in the whole dataset
+def encode_chunk(chunk, categories):
+    features = chunk[['FlightNumber', 'PayloadMass', 'Orbit', 'LaunchSite', 'Flights', 'GridFins', 'Reused', 'Legs', 'LandingPad', 'Block', 'ReusedCount', 'Serial']].copy()
+    for column, values in categories.items():
+        features[column] = pd.Categorical(features[column], categories=values)
+    return pd.get_dummies(features, columns=list(categories)).astype('float64')
+
+# Takes a dataset_part_1 file, writes dataset_part_2 and dataset_part_3 chunk by chunk and returns the value counts, landing rate and mean payload mass of the dataset
+def process_dataset_chunks(name='dataset_part_1', chunk_size=100000, format=None, part_2='dataset_part_2', part_3='dataset_part_3'):
+    chunks = lambda: readDatasetChunks(name, chunk_size, format=format)
+    stats = None
+    categories = {column: set() for column in ['Orbit', 'LaunchSite', 'LandingPad', 'Serial']}
+    counts = {column: pd.Series(dtype=np.float64) for column in ['LaunchSite', 'Orbit', 'Outcome']}
+    rows = landings = 0
+    for chunk in chunks():
+        stats = updatePayloadMassStats(chunk, stats)
+        for column, values in categories.items():
+            values.update(chunk[column].dropna().unique())
+        for column in counts:
+            counts[column] = counts[column].add(chunk[column].value_counts(), fill_value=0)
+        rows += len(chunk)
+        landings += decode_landing_class(chunk['Outcome']).sum()
+    categories = {column: sorted(values) for column, values in categories.items()}
+    labelled = (make_dataset_part_2(fillPayloadMass(chunk, stats)) for chunk in chunks())
+    encoded = (encode_chunk(chunk, categories) for chunk in writeDatasetChunks(labelled, part_2, format))
+    for chunk in writeDatasetChunks(encoded, part_3, format):
+        pass
+    summary = {column: count.astype(np.int64).sort_values(ascending=False) for column, count in counts.items()}
+    summary['Class'] = landings/rows
+    summary['PayloadMass'] = stats['sum'].sum()/stats['count'].sum()
+    return summary
+
+
+# For example, with a synthetic launch table of ten million rows:
+# 
+# <code>writeDataset(make_synthetic_launch_table(10000000).drop(columns='Class'), 'synthetic_part_1')</code>
+# 
+# <code>summary = process_dataset_chunks('synthetic_part_1', chunk_size=250000, part_2='synthetic_part_2', part_3='synthetic_part_3')</code>
+# 
+
+# ### A lazy backend for the wrangling and EDA stages
+# 
+# The wrangling and EDA labs run one pandas operation after another, and each of them makes a full copy of the data: filtering the launches, filling the payload masses, labelling the outcomes, parsing the dates, counting the values, grouping by orbit and year, and encoding the features. When <code>polars</code> is installed, <code>scan_launches</code> writes the same steps as one lazy plan over the dataset file instead. Nothing is read until the results are collected, and the planner then reads only the columns each result needs, applies the filter while scanning the file and runs the summaries together, sharing the scan between them. <code>wrangle_dataset</code> returns the summaries of the two labs and <code>dataset_part_3</code> with either backend, so the results can be compared with the pandas path.
+# 
+
+# In[ ]:
+
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+# Takes a dataset_part_1 file and returns a lazy plan of dataset_part_2 with the dates parsed and the missing payload masses filled
+def scan_launches(name, format=None):
+    path = name if os.path.splitext(name)[1] else name+'.'+(format or dataset_format)
+    scan = {'.csv': pl.scan_csv, '.parquet': pl.scan_parquet, '.feather': pl.scan_ipc}[os.path.splitext(path)[1]](path)
+    date = pl.col('Date').str.to_date('%Y-%m-%d') if scan.collect_schema()['Date'] == pl.String else pl.col('Date').cast(pl.Date)
+    payload_mass = pl.col('PayloadMass')
+    return (scan.filter(pl.col('BoosterVersion') != 'Falcon 1')
+                .with_columns(payload_mass.fill_null(payload_mass.mean().over(payload_mass_groups))
+                                          .fill_null(payload_mass.mean().over(payload_mass_groups[0]))
+                                          .fill_null(payload_mass.mean()),
+                              pl.col('Outcome').replace_strict(landing_outcome_class, return_dtype=pl.Int64).alias('Class'),
+                              date.alias('Date')))
+
+# Takes the lazy plan of dataset_part_2 and returns the plans of the value counts and success rates of the wrangling and EDA labs
+def lazy_summaries(launches):
+    # Missing values are left out of the groups, like pandas does
+    counts = {column: launches.drop_nulls(column).group_by(column).agg(pl.len().alias('count')).sort('count', descending=True) for column in ['LaunchSite', 'Orbit', 'Outcome']}
+    return {**counts,
+            'Class': launches.select(pl.col('Class').mean()),
+            'orbit_success': launches.drop_nulls('Orbit').group_by('Orbit').agg(pl.col('Class').mean()).sort('Orbit'),
+            'yearly_trend': launches.group_by(pl.col('Date').dt.year().alias('Year')).agg(pl.col('Class').mean()).sort('Year')}
+
+# Takes the lazy plan of dataset_part_2 and the values of each categorical column and returns the plan of the features, with the categorical columns as enums of their values
+def lazy_features(launches, categories):
+    numeric = ['FlightNumber', 'PayloadMass', 'Flights', 'GridFins', 'Reused', 'Legs', 'Block', 'ReusedCount']
+    return launches.select(*[pl.col(column).cast(pl.Float64) for column in numeric], *[pl.col(column).cast(pl.Enum(values)) for column, values in categories.items()])
+
+# Takes a dataset_part_1 file and returns the summaries of the wrangling and EDA labs and dataset_part_3, or None when features is False, computed with polars when backend is 'polars' and with pandas when it is 'pandas'
+def wrangle_dataset(name, backend=None, format=None, features=True):
+    backend = backend or ('polars' if pl is not None else 'pandas')
+    if backend == 'polars':
+        launches = scan_launches(name, format)
+        columns = ['Orbit', 'LaunchSite', 'LandingPad', 'Serial']
+        plans = lazy_summaries(launches)
+        results = pl.collect_all([*plans.values(), *(launches.select(pl.col(column).drop_nulls().unique().sort()) for column in columns)])
+        summaries = {key: result.to_pandas() for key, result in zip(plans, results)}
+        categories = {column: result[column].to_list() for column, result in zip(columns, results[len(plans):])}
+        if not features:
+            return summaries, None
+        # The enums are one hot encoded in the order of their values, like get_dummies does, and handed to pandas as one float64 array
+        features = lazy_features(launches, categories).collect().to_dummies(columns, drop_nulls=True)
+        return summaries, pd.DataFrame(features.to_numpy(), columns=features.columns, copy=False)
+    df = readDataset(name, format=format)
+    df = imputePayloadMass(df[df['BoosterVersion'] != 'Falcon 1'].reset_index(drop=True))
+    df['Class'] = decode_landing_class(df['Outcome'])
+    add_date_features(df)
+    summaries = {column: df[column].value_counts() for column in ['LaunchSite', 'Orbit', 'Outcome']}
+    summaries.update({'Class': df['Class'].mean(),
+                      'orbit_success': df.groupby('Orbit')['Class'].mean(),
+                      'yearly_trend': df.groupby('Year')['Class'].mean()})
+    return summaries, make_dataset_part_3(df) if features else None
+
+# Takes a list of numbers of rows, writes a synthetic dataset_part_1 of each size in chunks and returns the time each backend takes to compute the summaries alone and together with dataset_part_3
+def benchmark_lazy_backend(sizes=(1000000, 50000000), chunk_size=1000000, format='parquet', backends=('pandas', 'polars')):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for n_rows in sizes:
+            name = os.path.join(directory, 'synthetic_part_1_%d' % n_rows)
+            chunks = (make_synthetic_launch_table(min(chunk_size, n_rows-offset), seed=offset).drop(columns='Class').assign(FlightNumber=lambda chunk: chunk['FlightNumber']+offset)
+                      for offset in range(0, n_rows, chunk_size))
+            for chunk in writeDatasetChunks(chunks, name, format):
+                pass
+            for backend in backends:
+                for features in (False, True):
+                    start = time.perf_counter()
+                    output = wrangle_dataset(name, backend, format, features)
+                    results.append({'rows': n_rows, 'backend': backend, 'features': features, 'seconds': time.perf_counter()-start})
+                    del output
+    return pd.DataFrame(results)
+
+
+# For example, <code>benchmark_lazy_backend()</code> wrangles synthetic datasets of one and fifty million launches with both backends. The pandas path needs several times the size of the dataset in memory at fifty million rows, so on a smaller machine pass smaller <code>sizes</code>.
+# 
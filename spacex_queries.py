@@ -0,0 +1,132 @@
+# The ten SQL tasks of the capstone as functions over SPACEXTABLE, so the dashboard and the reports can run them without the %sql magic.
+# Every task runs its statement from statements with ? parameters on one shared connection, which keeps the compiled statement and reuses it on every call.
+# The notebook checks the query plans of the same statements, so the SQL of the tasks is only written here.
+# Results are cached by their statement and parameters, and the cache is emptied when the database changes: the key holds the number of rows this
+# connection has changed and SQLite's data_version, which moves on whenever another connection, in this process or another, commits a change.
+# Tasks 1, 3, 4, 7 and 10 read the summary tables that create_spacex_summaries in the notebook keeps up to date with triggers.
+import sqlite3
+import threading
+
+database_path = 'my_data1.db'
+
+# The statement of every task, with ? for its parameters
+statements = {
+'task_1': 'SELECT "Launch_Site" FROM launch_site_summary',
+'task_2': 'SELECT * FROM SPACEXTABLE WHERE "Launch_Site" LIKE ? ESCAPE \'\\\' LIMIT ?',
+'task_3': 'SELECT SUM("Payload_Mass") FROM customer_summary WHERE "Customer" = ?',
+'task_4': 'SELECT CAST(SUM("Payload_Mass") AS REAL)/SUM("Payload_Launches") FROM booster_version_summary WHERE "Booster_Version" = ?',
+'task_5': 'SELECT MIN("Date") FROM SPACEXTABLE WHERE "Landing_Outcome" = ?',
+'task_6': 'SELECT "Booster_Version" FROM SPACEXTABLE WHERE "Landing_Outcome" = ? AND "PAYLOAD_MASS__KG_" > ? AND "PAYLOAD_MASS__KG_" < ?',
+'task_7': 'SELECT "Mission_Outcome", "Launches" FROM mission_outcome_summary ORDER BY "Mission_Outcome"',
+'task_8': 'SELECT "Booster_Version" FROM SPACEXTABLE WHERE "PAYLOAD_MASS__KG_" = (SELECT MAX("PAYLOAD_MASS__KG_") FROM SPACEXTABLE)',
+'task_9': 'SELECT "Month", "Landing_Outcome", "Booster_Version", "Launch_Site" FROM SPACEXTABLE WHERE "Landing_Outcome" = ? AND "Year" = ?',
+'task_10': 'SELECT "Landing_Outcome", SUM("Launches") AS Count FROM landing_outcome_summary WHERE "Date_Key" BETWEEN ? AND ? GROUP BY "Landing_Outcome" ORDER BY Count DESC'}
+
+# The parameters of the questions asked in the capstone, bound to the statements when their query plans are checked
+example_parameters = {'task_2': ('CCA%', 5), 'task_3': ('NASA (CRS)',), 'task_4': ('F9 v1.1',), 'task_5': ('Success (ground pad)',),
+                      'task_6': ('Success (drone ship)', 4000, 6000), 'task_9': ('Failure (drone ship)', 2015), 'task_10': (20100604, 20170320)}
+
+
+_connection = None
+_lock = threading.Lock()
+_cache = {}
+_table_version = 0
+
+
+# Takes the path of the database, opens the shared connection the first time and returns it
+def connect(path=None):
+    global _connection, database_path
+    with _lock:
+        if path is not None and path != database_path and _connection is not None:
+            _connection.close()
+            _connection = None
+            _cache.clear()
+        database_path = path or database_path
+        if _connection is None:
+            # The dashboard calls the tasks from its worker threads, the lock keeps them from using the connection at the same time
+            _connection = sqlite3.connect(database_path, check_same_thread=False, cached_statements=64)
+        return _connection
+
+
+# Empties the cache, which changes to the database empty by themselves, so this is only needed to read the tasks again from scratch
+def invalidate():
+    global _table_version
+    with _lock:
+        _table_version += 1
+        _cache.clear()
+
+
+# Closes the shared connection and empties the cache
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+        _cache.clear()
+
+
+# Takes a statement and its parameters and returns the rows as a tuple, from the cache when the database has not changed since they were read
+def _query(sql, params=()):
+    con = _connection or connect()
+    with _lock:
+        key = (sql, params, _table_version, con.execute('PRAGMA data_version').fetchone()[0], con.total_changes)
+        rows = _cache.get(key)
+        if rows is None:
+            rows = tuple(con.execute(sql, params).fetchall())
+            # Results of an older version of the database can never be asked for again
+            if any(cached[2:] != key[2:] for cached in _cache):
+                _cache.clear()
+            _cache[key] = rows
+    return rows
+
+
+# Task 1: the names of the launch sites
+def unique_launch_sites():
+    return tuple(site for site, in _query(statements['task_1']))
+
+
+# Task 2: the first records of the launch sites that begin with the prefix
+def launch_sites_with_prefix(prefix='CCA', limit=5):
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')+'%'
+    return _query(statements['task_2'], (pattern, limit))
+
+
+# Task 3: the total payload mass carried for the customer
+def total_payload_mass(customer='NASA (CRS)'):
+    return _query(statements['task_3'], (customer,))[0][0]
+
+
+# Task 4: the average payload mass carried by the booster version
+def average_payload_mass(booster_version='F9 v1.1'):
+    return _query(statements['task_4'], (booster_version,))[0][0]
+
+
+# Task 5: the date of the first launch with the landing outcome
+def first_landing_date(landing_outcome='Success (ground pad)'):
+    return _query(statements['task_5'], (landing_outcome,))[0][0]
+
+
+# Task 6: the boosters with the landing outcome that carried more than min_mass and less than max_mass
+def boosters_by_landing_and_payload(landing_outcome='Success (drone ship)', min_mass=4000, max_mass=6000):
+    return tuple(booster for booster, in _query(statements['task_6'], (landing_outcome, min_mass, max_mass)))
+
+
+# Task 7: the number of launches with each mission outcome
+def mission_outcome_counts():
+    return dict(_query(statements['task_7']))
+
+
+# Task 8: the boosters that carried the maximum payload mass
+def boosters_with_max_payload():
+    return tuple(booster for booster, in _query(statements['task_8']))
+
+
+# Task 9: the month, landing outcome, booster and launch site of the launches of the year with the landing outcome
+def landings_by_month(year=2015, landing_outcome='Failure (drone ship)'):
+    return _query(statements['task_9'], (landing_outcome, year))
+
+
+# Task 10: the landing outcomes between two dates given as 'YYYY-MM-DD', from the most to the least common
+def rank_landing_outcomes(start='2010-06-04', end='2017-03-20'):
+    return _query(statements['task_10'], (int(start.replace('-', '')), int(end.replace('-', ''))))